@@ -25,6 +25,7 @@
 
 
 import sys
+import argparse
 import os
 import os.path
 import re
@@ -32,7 +33,10 @@ import numpy as np
 import pandas as pd
 import glob
 
-from utils.utils import check_dir, clean_dir, write_json
+from utils.utils import scratch_dir, Staging, write_json
+from utils.meta import load_meta
+from utils.profiling import enable, traced
+from utils.progress import Progress
 import settings
 
 
@@ -72,28 +76,6 @@ def get_years(current=True):
   return years
 
 
-def build_set(search,search_col,result,csv):
-  """Perform a lookup and return the matching results for the row in a set
-  
-  Parameters
-  ----------
-  search    : string
-              The value to search for
-  search_col: string
-              The column to perform the search on
-  result    : string
-              The column with the result
-  csv       : string
-              The name of the CSV file to be parsed
-  """
-  df = pd.read_csv(csv)
-  s = set()
-  for index, row in df.iterrows():
-    if row[search_col] == search:
-      s.add(row[result])
-  return s
-   
-
 def build_col_index(fn,sheet):
   """Build an index for the columns in the Excel sheet that should be parsed.
 
@@ -143,6 +125,11 @@ def indicator_active(aa,ind):
   return ind_active
 
 
+# In compact mode the ranks are stored as small integers, with this value for
+# the areas without a rank
+rank_null = -1
+
+
 def rank_dict(df,ind,yr):
   """Returns a dict with type of ranking as key and the rank as value.
   Eg. { 'overall_ranking': 16, 'regional_ranking': 9 }
@@ -165,7 +152,7 @@ def rank_dict(df,ind,yr):
   # Check if it is not null and if so, add it.
   for key, value in rankings.iteritems():
     rank = df.loc[ind,(yr,key)]
-    if pd.isnull(rank):
+    if pd.isnull(rank) or rank == rank_null:
       aa_ranks[value] = None
     else:
       aa_ranks[value] = int(rank)
@@ -173,6 +160,7 @@ def rank_dict(df,ind,yr):
   return aa_ranks
 
 
+@traced
 def get_raw_data(df,ind,lang,yr):
   """Returns a dict with the value and unit of the raw data for an indicator.
 
@@ -198,6 +186,7 @@ def get_raw_data(df,ind,lang,yr):
   }
 
 
+@traced
 def get_rank(aal,df,name):
   """Build a dataframe that ranks a list of administrative areas on every
   variable available (score, parameter, indicator)
@@ -236,6 +225,7 @@ def get_rank(aal,df,name):
   return df
 
 
+@traced
 def build_json_aa(aa,df_data,lang,indicators=False,historic=False,single_p=None):
   """Build the dict with data for a particular administrative area for export
   to JSON.
@@ -367,7 +357,7 @@ def build_json_aa(aa,df_data,lang,indicators=False,historic=False,single_p=None)
 
       # The indicator_group is a list with dicts for each indicator
       # Fetch the indicator groups for this parameter
-      param_groups = build_set(param,'parent','id',settings.src_meta_index)
+      param_groups = set(meta.children(param))
       gl = []
       for group in param_groups:
         group_data = {}
@@ -375,7 +365,7 @@ def build_json_aa(aa,df_data,lang,indicators=False,historic=False,single_p=None)
         gl.append(group_data)
 
         # Build a set with all the indicators for this group
-        group_inds = build_set(group,'parent','id',settings.src_meta_index)
+        group_inds = set(meta.children(group))
         il = []
         for ind in group_inds:
           # Not every country has data on every indicator. Check if it's in the index.
@@ -436,7 +426,7 @@ def build_json_aa(aa,df_data,lang,indicators=False,historic=False,single_p=None)
   # When dealing with a country, add data about the states
   if df_meta_aa.ix[aa,'type'] == 'country':
     # Check if there are any states or provinces for this country
-    country_states = build_set(aa,'country','iso',settings.src_meta_aa)
+    country_states = set(meta.states(aa))
 
     # Loop over the country states
     state_list = []
@@ -475,18 +465,83 @@ def pivot_df(df,ind,col,val):
   return df
 
 
-def main():
+def frame_memory(*dfs):
+  """Returns the memory used by one or more dataframes in bytes, including
+  the strings in object columns.
+  """
+  return sum([df.memory_usage(index=True,deep=True).sum() for df in dfs])
+
+
+def compact_ranks(df):
+  """Store the rank columns of df as small integers, with rank_null for the
+  areas without a rank.
+
+  Parameters
+  ----------
+  df        : dataframe
+              The dataframe with the (year, 'gr') and (year, 'sr') columns
+  """
+  for col in df.columns:
+    if col[1] in ('gr', 'sr'):
+      ranks = df[col].fillna(rank_null)
+      dtype = np.int16 if ranks.max() <= np.iinfo(np.int16).max else np.int32
+      df[col] = ranks.astype(dtype)
+  return df
+
+
+def compact_values(df):
+  """Store the value and data columns of df as float32 where that doesn't
+  change the output. The values end up in the CSV files and the rankings as
+  they are, so they are only stored as float32 when that is lossless. The
+  data only ends up in the JSON, so it is stored as float32 when every value
+  still rounds to the same 5 decimals. Other columns stay float64.
+
+  Parameters
+  ----------
+  df        : dataframe
+              The dataframe with the (year, 'value') and (year, 'data') columns
+  """
+  for col in df.columns:
+    if col[1] not in ('value', 'data') or df[col].dtype != np.float64:
+      continue
+    values = df[col].values
+    compact = values.astype(np.float32)
+    valid = ~np.isnan(values)
+    if col[1] == 'value':
+      lossless = (compact[valid].astype(np.float64) == values[valid]).all()
+    else:
+      lossless = all([round(a,5) == round(float(b),5) for a, b in zip(values[valid], compact[valid])])
+    if lossless:
+      df[col] = compact
+  return df
+
+
+def compact_meta(df, cols):
+  """Returns a copy of a metadata frame with the code columns (eg. type,
+  grid, region) as categoricals. The frame itself isn't changed.
+
+  Parameters
+  ----------
+  df        : dataframe
+              The metadata frame
+  cols      : list
+              The columns with codes
+  """
+  df = df.copy()
+  for col in cols:
+    if col in df.columns and df[col].dtype == object:
+      df[col] = df[col].astype('category')
+  return df
+
+
+def build(staging, compact=False):
+  """Build the core data and write it to the staging area, see main.
+  """
 
   #############################################################################
   # 0.
   #
 
-  # Check if tmp folder exists, otherwise create it
-  if check_dir(settings.tmp_dir) == True:
-    sys.exit(0)
-  else:
-    os.makedirs(settings.tmp_dir)
-
   # Run some checks on the source folder with core data.
   if not get_years():
     # Is there anything in the source folder to begin with?
@@ -517,15 +572,19 @@ def main():
 
   print "Loading the core and meta data..."
 
+  # Parse the meta-data once and set the scope to global
+  global meta
+  meta = load_meta(settings.src_meta_aa, settings.src_meta_index, settings.meta_snapshot)
+
   # Build the different sets of admin areas with things we have to loop over.
-  countries = build_set('country','type','iso',settings.src_meta_aa)
-  states = build_set('state','type','iso',settings.src_meta_aa)
+  countries = set(meta.areas('country'))
+  states = set(meta.areas('state'))
   admin_areas = countries | states
   
   # Build sets for the variables we loop over
   global index_param
-  index_param = build_set('param','type','id',settings.src_meta_index)
-  index_score = build_set('score','type','id',settings.src_meta_index)
+  index_param = set(meta.ids('param'))
+  index_score = set(meta.ids('score'))
   sp = list(index_score | index_param)
 
   # Build set for the years we're interested in
@@ -535,11 +594,11 @@ def main():
   current_yr = max(years)
 
 
-  # Read in the files with meta-data and set the scope to global
+  # The frames with meta-data, indexed on iso and id
   global df_meta_aa
-  df_meta_aa = pd.read_csv(settings.src_meta_aa,index_col='iso')
+  df_meta_aa = meta.df_aa
   global df_meta_index
-  df_meta_index = pd.read_csv(settings.src_meta_index,index_col='id')
+  df_meta_index = meta.df_index
 
 
   #############################################################################
@@ -604,6 +663,28 @@ def main():
 
   df_full.sortlevel(axis=1,inplace=True)
 
+  # The frames of the last year and sheet are in df_full now
+  del df_yr, df_sheet
+
+
+  # 1.1 Compact the frames
+  # In compact mode, the frames are made smaller right after they are built,
+  # so the CSV files, the rankings and the JSON files are built from the
+  # compact frames. The iso codes and ids of df_full are stored once in the
+  # levels of its MultiIndex already. The metadata of this process gets the
+  # compact frames too, so the original ones are freed.
+  if compact:
+    before = frame_memory(df_full, df_meta_aa, df_meta_index)
+    df_full = compact_values(df_full)
+    meta.df_aa = df_meta_aa = compact_meta(df_meta_aa, ['type', 'grid', 'region', 'country'])
+    meta.df_index = df_meta_index = compact_meta(df_meta_index, ['type', 'grid'])
+    after = frame_memory(df_full, df_meta_aa, df_meta_index)
+    value_cols = [col for col in df_full.columns if col[1] in ('value', 'data')]
+    float32_cols = [col for col in value_cols if df_full[col].dtype == np.float32]
+    print "Compacted the data and meta frames from %.1f kB to %.1f kB "\
+          "(%s of %s value columns as float32)" % (before / 1024.0, after / 1024.0, len(float32_cols), len(value_cols))
+
+
   #############################################################################
   # 2. CSV downloads
   #
@@ -640,7 +721,7 @@ def main():
     columns = columns + list(years)
 
     file_path = (settings.exp_full_csv).format(lang=lang)
-    df_full_csv.loc[slice(None),columns].to_csv(file_path,encoding='UTF-8',index=False)
+    df_full_csv.loc[slice(None),columns].to_csv(staging.path(file_path),encoding='UTF-8',index=False)
   
 
   # 2.1 Generate the main CSV files
@@ -651,20 +732,26 @@ def main():
   for lang in settings.langs:
     # Pivot the DF and export it
     file_path = (settings.exp_current_csv).format(lang=lang, yr=current_yr)
-    pivot_df(df_main_csv,'name:' + lang + '_aa','name:' + lang + '_var',current_yr).to_csv(file_path,encoding='UTF-8')
+    pivot_df(df_main_csv,'name:' + lang + '_aa','name:' + lang + '_var',current_yr).to_csv(staging.path(file_path),encoding='UTF-8')
 
 
   # 2.3 Generate the country + state CSV files
+  progress = Progress('CSV files per area', len(admin_areas), settings.progress_log)
   for aa in admin_areas:
-    # Select the data of this admin area
-    df_aa_csv = df_full_csv.loc[(aa,slice(None)),:]
-    for lang in settings.langs:
-      # Include the name of the var, its type and the years
-      columns = ['name:' + lang + '_var','type_var'] + list(years)
+    with progress.item(aa):
+      # Select the data of this admin area
+      df_aa_csv = df_full_csv.loc[(aa,slice(None)),:]
+      for lang in settings.langs:
+        # Include the name of the var, its type and the years
+        columns = ['name:' + lang + '_var','type_var'] + list(years)
+
+        # Select the proper columns and generate the CSV
+        file_path = (settings.exp_aa_csv).format(lang = lang, aa = aa.lower())
+        df_aa_csv.loc[slice(None),columns].to_csv(staging.path(file_path),encoding='UTF-8',index=False)
+  progress.finish()
 
-      # Select the proper columns and generate the CSV
-      file_path = (settings.exp_aa_csv).format(lang = lang, aa = aa.lower())
-      df_aa_csv.loc[slice(None),columns].to_csv(file_path,encoding='UTF-8',index=False)
+  # The frames of the CSV files aren't needed anymore
+  df_full_csv = df_main_csv = df_aa_csv = df_meta_aa_csv = df_meta_index_csv = None
 
 
   #############################################################################
@@ -701,11 +788,21 @@ def main():
   # The state rank ('sr') ranks the STATES of a particular country
   for country in countries:
     # Check if there are any states or provinces for this country
-    cs = build_set(country,'country','iso',settings.src_meta_aa)
+    cs = set(meta.states(country))
     if cs:
       df_full = get_rank(cs,df_full,'sr')
 
 
+  # 3.4 Compact the ranks
+  # The ranks are floats with NaN for the areas without a rank. In compact
+  # mode they are stored as small integers as soon as they are calculated.
+  if compact:
+    before = frame_memory(df_full, df_meta_aa, df_meta_index)
+    df_full = compact_ranks(df_full)
+    after = frame_memory(df_full, df_meta_aa, df_meta_index)
+    print "Compacted the ranks, the data and meta frames went from %.1f kB to %.1f kB" % (before / 1024.0, after / 1024.0)
+
+
   #############################################################################
   # 4. JSON api
   #
@@ -730,24 +827,45 @@ def main():
 
     # Write the list to a JSON file
     file_path = (settings.exp_core).format(lang=lang)
-    write_json(file_path, sorted_data)
+    write_json(file_path, sorted_data, staging)
 
 
   # 4.3 Generate the country + state JSON files
+  progress = Progress('JSON files per area', len(admin_areas), settings.progress_log)
   for aa in admin_areas:
-    for lang in settings.langs:
-      # Get the data for this admin area in a dict
-      json_data = build_json_aa(aa,df_full,lang,indicators=True,historic=True)
+    with progress.item(aa):
+      for lang in settings.langs:
+        # Get the data for this admin area in a dict
+        json_data = build_json_aa(aa,df_full,lang,indicators=True,historic=True)
 
-      # Write the dict to a JSON file
-      file_path = (settings.exp_aa).format(lang=lang,aa=aa.lower())
-      write_json(file_path, json_data)
+        # Write the dict to a JSON file
+        file_path = (settings.exp_aa).format(lang=lang,aa=aa.lower())
+        write_json(file_path, json_data, staging)
+  progress.finish()
 
 
-  # Fully remove the temp directory
-  clean_dir(settings.tmp_dir , True)
+  # Move the output into the export folder
+  staging.commit()
 
   print "All done. The data has been prepared for use on global-climatescope.org."
 
+
+@traced
+def main(compact=False):
+  # Every run gets its own scratch folder, so runs don't clobber each other.
+  # The output is staged in it and only moved into the export folder when
+  # the run is done. The folder is removed when the run ends, also when it
+  # fails.
+  with scratch_dir('cs-core-', settings.tmp_dir) as d:
+    build(Staging(settings.export_dir, d), compact)
+
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  parser = argparse.ArgumentParser(description='Build the core data of the Climatescope.')
+  parser.add_argument('--compact', action='store_true', help='Store the data with smaller types (categoricals, integer ranks and float32 values where the output allows it) to use less memory.')
+  parser.add_argument('--profile', metavar='FILE', help='Write the time of the traced functions as collapsed stacks to this file. Same as setting CS_PROFILE.')
+  args = parser.parse_args()
+
+  if args.profile:
+    enable(args.profile)
+
+  main(compact=args.compact)
\ No newline at end of file
@@ -11,26 +11,43 @@
 # USAGE
 #
 # Example: python cs-profile.py
+#
+# Multiple profile sources can be passed, later ones complete earlier ones:
+# python cs-countries-profile.py source/cs-profiles/profiles.csv extra.csv
+#
+# To build the profiles with historic values from profiles-<year>.csv:
+# python cs-countries-profile.py --historic
 
 import sys
 import os
+import re
+import argparse
 import os.path
 import csv
-import shutil
-import json
-import errno
+import numpy as np
+
+from utils.meta import load_meta
+from utils.profiling import enable, traced
+from utils.utils import scratch_dir, Staging, write_json
 
 
 # Directory structure
 src_dir = 'source/'
 export_dir = 'data/'
+# Every run gets its own scratch folder in here
+tmp_dir = 'tmp/'
 
 # Source - filenames / dirs
 src_meta_aa = src_dir + 'meta/admin_areas.csv'
+src_meta_index = src_dir + 'meta/index.csv'
+meta_snapshot = 'cache/meta.pickle'
 src_profile_aa = src_dir + 'cs-profiles/profiles.csv'
+# Folder with the profile data of previous editions, named profiles-<year>.csv
+src_profile_dir = src_dir + 'cs-profiles/'
 # Directory path for final data export.
 # Language will be replaced before saving the file.
 country_profile_export = export_dir + '{lang}/api/countries-profile/'
+country_profile_historic_export = export_dir + '{lang}/api/countries-profile-historic/'
 
 langs = ['en', 'es']
 indicators = [
@@ -116,108 +133,299 @@ indicators = [
 ]
 
 
-def clean_dir(path):
-  """Cleans a directory by deleting it and creating it again.
-  
+def as_float(values):
+  """Returns the values as a float array."""
+  return np.asarray(values, dtype=float)
+
+
+def round_values(values, digits):
+  """Rounds the values like round() does: halves are rounded away from zero.
+  np.round would round them to even. Values that are about half-way are
+  rounded with round() itself, as the scaled float can be off in the last
+  bit."""
+  values = as_float(values)
+  scale = 10.0 ** digits
+  scaled = np.abs(values) * scale
+  result = np.copysign(np.floor(scaled + 0.5) / scale, values)
+  with np.errstate(invalid='ignore'):
+    halfway = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+  if halfway.any():
+    result[halfway] = [round(value, digits) for value in values[halfway]]
+  return result
+
+
+# The conversions that can be applied to the profile data. Every conversion
+# works on a whole column of values at once.
+conversion_steps = {
+  'round1': lambda values: round_values(values, 1),
+  'round2': lambda values: round_values(values, 2),
+  'round3': lambda values: round_values(values, 3),
+  'round4': lambda values: round_values(values, 4),
+  'million': lambda values: as_float(values) / 1000000,
+  'int': lambda values: np.where(np.isnan(as_float(values)), 0, values).astype(int),
+  'percent': lambda values: as_float(values) * 100
+}
+
+
+def compile_conversion(conversion_str):
+  """Compiles a series of conversions into a function that applies them to
+  an array of values. Without conversions, the values are only converted to
+  float.
+  Raises a ValueError for unknown conversions.
+
   Parameters
   ----------
-  path      : string
-              The directory to wipe
+  conversion_str: : string
+                    The conversions to apply separated by |
   """
-  try:
-    shutil.rmtree(path)
-  except OSError as exception:
-    if exception.errno != errno.ENOENT:
-      raise
-  try:
-    os.makedirs(path)
-  except OSError as exception:
-    if exception.errno != errno.EEXIST:
-      raise
-
-
-def get_aa_list():
-  """ Returns a list of iso codes for the states and countries from the admin_areas.csv
+  steps = []
+  if conversion_str:
+    for conv in conversion_str.split('|'):
+      if conv not in conversion_steps:
+        raise ValueError("Unknown conversion '%s' in '%s'" % (conv, conversion_str))
+      steps.append(conversion_steps[conv])
+
+  def convert(values):
+    values = as_float(values)
+    for step in steps:
+      values = step(values)
+    return values
+
+  return convert
+
+
+def compile_conversions():
+  """Compiles the conversions of all the indicators. Returns a dict with the
+  conversion function for every indicator id.
   """
-  aareas = [];
-  ifile = csv.DictReader(open(src_meta_aa))
-  for row in ifile:
-    if row["type"] == 'country' or row["type"] == 'state':
-      aareas.append(row["iso"])
-  return aareas
+  conversions = {}
+  for indicator in indicators:
+    conversions[indicator['id']] = compile_conversion(indicator.get('conversion'))
+  return conversions
 
 
-def apply_conversion(conversion_str, value):
-  """Applies a series of conversions to a value.
-  The value is converted to float so it only makes sense to
-  use this on numeric values.
+@traced
+def convert_profiles(profiles, conversions):
+  """Converts the profile data column by column. Returns a dict indexed by
+  iso with the converted value of every indicator, or None if the area has no
+  data for it.
 
   Parameters
   ----------
-  conversion_str: : string
-                    The conversions to apply separated by |
-  value:          : mixed
-                    The value to which the conversions are to be applied
+  profiles:       : dict
+                    The rows with profile data, indexed by iso
+  conversions:    : dict
+                    The conversion function for every indicator id
   """
+  isos = sorted(profiles.keys())
+  converted = dict((iso, {}) for iso in isos)
+
+  for id_ind, convert in conversions.items():
+    # Empty values are parsed as NaN and left out after the conversion
+    raw = np.array([profiles[iso].get(id_ind) or 'nan' for iso in isos], dtype=float)
+    values = convert(raw).tolist()
+    missing = np.isnan(raw)
+    for i, iso in enumerate(isos):
+      converted[iso][id_ind] = None if missing[i] else values[i]
 
-  if conversion_str == '' or conversion_str == None:
-    return value
-
-  conversions = conversion_str.split('|');
-  for conv in conversions:
-    if conv == 'round1':
-      value = round(float(value), 1)
-    elif conv == 'round2':
-      value = round(float(value), 2)
-    elif conv == 'round3':
-      value = round(float(value), 3)
-    elif conv == 'round4':
-      value = round(float(value), 4)
-    elif conv == 'million':
-      value = float(value) / 1000000
-    elif conv == 'int':
-      value = int(value)
-    elif conv == 'percent':
-      value = float(value) * 100
-
-  return value
-
-
-def main():
-  # Prepare export directories.
-  for lang in langs:
-    clean_dir(country_profile_export.format(lang=lang))
+  return converted
+
+
+@traced
+def load_profiles(sources):
+  """Reads the profile sources once and indexes the rows by iso.
+  When an area is in more than one source, the values of the later sources
+  complete or override those of the earlier ones. Empty values never
+  override a value.
+
+  Parameters
+  ----------
+  sources:        : list
+                    Paths to the CSV files with profile data
+  """
+  profiles = {}
+  for source in sources:
+    profile_data = csv.DictReader(open(source))
+    for row in profile_data:
+      profile = profiles.setdefault(row["iso"], {})
+      for key, value in row.items():
+        if value or key not in profile:
+          profile[key] = value
+  return profiles
+
+
+def build_profile(aa, lang, values):
+  """Builds the dict with the profile of an admin area for export to JSON.
+
+  Parameters
+  ----------
+  aa:             : string
+                    The iso code of the admin area
+  lang:           : string
+                    The active language
+  values:         : dict
+                    The converted values of the area, or None if there is no
+                    data for it
+  """
+  iso = aa.lower()
+  # Init with defaults.
+  country_data = { 'name': iso, 'iso': iso, 'indicators': [] }
+
+  if values is None:
+    return country_data
+
+  for indicator in indicators:
+    id_ind = indicator['id']
+
+    # Only interested in the indicator if there is data
+    if values[id_ind] is not None:
+      indicator_to_append = { 'id': id_ind, 'name': indicator['name'][lang], 'unit': indicator['unit'][lang], 'value': values[id_ind] }
+      country_data['indicators'].append(indicator_to_append)
+
+  return country_data
+
+
+def get_profile_years():
+  """Returns a dict with the path to the profile source of every year. To
+  determine this, the files in the profile folder are checked for properly
+  formatted names (eg. profiles-2015.csv).
+  """
+  fn_pattern = re.compile('^profiles-(20[0-9]{2})\.csv$')
+  year_sources = {}
+  for f in os.listdir(src_profile_dir):
+    match = fn_pattern.match(f)
+    if match:
+      year_sources[int(match.group(1))] = os.path.join(src_profile_dir, f)
+  return year_sources
+
+
+@traced
+def load_historic_profiles(year_sources, conversions):
+  """Reads the profile sources of all the years once. Returns a dict with
+  the converted values indexed by iso, for every year.
+
+  Parameters
+  ----------
+  year_sources:   : dict
+                    The path to the profile source of every year
+  conversions:    : dict
+                    The conversion function for every indicator id
+  """
+  historic = {}
+  for yr, source in year_sources.items():
+    historic[yr] = convert_profiles(load_profiles([source]), conversions)
+  return historic
+
+
+def build_historic_profile(aa, lang, historic):
+  """Builds the dict with the profile of an admin area for all the years.
+  Every indicator with data in at least one year is included, with a value
+  for every year. Years without data have None as value.
+
+  Parameters
+  ----------
+  aa:             : string
+                    The iso code of the admin area
+  lang:           : string
+                    The active language
+  historic:       : dict
+                    The converted values indexed by iso, for every year
+  """
+  iso = aa.lower()
+  country_data = { 'name': iso, 'iso': iso, 'indicators': [] }
+  years = sorted(historic.keys())
+
+  for indicator in indicators:
+    id_ind = indicator['id']
+
+    ind_data = []
+    for yr in years:
+      values = historic[yr].get(aa)
+      value = None
+      if values:
+        value = values[id_ind]
+      ind_data.append({ 'year': yr, 'value': value })
+
+    # Only interested in the indicator if there is data
+    if [yr_data for yr_data in ind_data if yr_data['value'] is not None]:
+      country_data['indicators'].append({ 'id': id_ind, 'name': indicator['name'][lang], 'unit': indicator['unit'][lang], 'data': ind_data })
+
+  return country_data
+
+
+@traced
+def main_historic():
+  # Compile the conversions first, so a bad config fails before any output
+  conversions = compile_conversions()
+
+  # Build the list with countries and states
+  admin_areas = load_meta(src_meta_aa, src_meta_index, meta_snapshot).areas('country', 'state')
+
+  # Read the profile data of all the years once
+  historic = load_historic_profiles(get_profile_years(), conversions)
+
+  # The profiles are written to a staging area in the scratch folder of this
+  # run. The export directories are replaced by the staged ones when they
+  # are done, so other runs never see them half-written. The scratch folder
+  # is removed when the run ends, also when it fails.
+  with scratch_dir('cs-countries-profile-', tmp_dir) as d:
+    staging = Staging(export_dir, d)
+    for lang in langs:
+      staging.replace(country_profile_historic_export.format(lang=lang))
+
+    for aa in admin_areas:
+      for lang in langs:
+        country_data = build_historic_profile(aa, lang, historic)
+
+        # Write the list to a JSON file
+        file_path = (country_profile_historic_export + '{iso}.json').format(lang=lang, iso=aa.lower())
+        write_json(file_path, country_data, staging)
+
+    staging.commit()
+
+
+@traced
+def main(sources=None):
+  if not sources:
+    sources = [src_profile_aa]
+
+  # Compile the conversions first, so a bad config fails before any output
+  conversions = compile_conversions()
 
   # Build the list with countries and states
-  admin_areas = get_aa_list()
+  admin_areas = load_meta(src_meta_aa, src_meta_index, meta_snapshot).areas('country', 'state')
 
-  for aa in admin_areas:
-    iso = aa.lower()
+  # Read the profile data once and convert it column by column
+  profiles = convert_profiles(load_profiles(sources), conversions)
+
+  # Stage the profiles, like main_historic
+  with scratch_dir('cs-countries-profile-', tmp_dir) as d:
+    staging = Staging(export_dir, d)
     for lang in langs:
-      # Init with defaults.
-      country_data = { 'name': iso, 'iso': iso, 'indicators': [] }
-
-      # Read the profile data
-      profile_data = csv.DictReader(open(src_profile_aa))
-      for row in profile_data:
-        if row["iso"] == aa:
-          for indicator in indicators:
-            id_ind = indicator['id']
-
-            # Only interested in the indicator if there is data
-            if row[id_ind]:
-              indicator_to_append = { 'id': id_ind, 'name': indicator['name'][lang], 'unit': indicator['unit'][lang] }
-              if 'conversion' in indicator:
-                indicator_to_append['value'] = apply_conversion(indicator['conversion'], row[id_ind])
-              else:
-                indicator_to_append['value'] = float(row[id_ind])
-              country_data['indicators'].append(indicator_to_append)
-
-      # Write the list to a JSON file
-      file_path = (country_profile_export + '{iso}.json').format(lang=lang, iso=iso)
-      with open(file_path, 'w') as ofile:
-        json.dump(country_data, ofile)
+      staging.replace(country_profile_export.format(lang=lang))
+
+    for aa in admin_areas:
+      for lang in langs:
+        country_data = build_profile(aa, lang, profiles.get(aa))
+
+        # Write the list to a JSON file
+        file_path = (country_profile_export + '{iso}.json').format(lang=lang, iso=aa.lower())
+        write_json(file_path, country_data, staging)
+
+    staging.commit()
 
 
 if __name__ == "__main__":
-  main()
+  parser = argparse.ArgumentParser(description='Build the profiles of the countries and states.')
+  parser.add_argument('sources', nargs='*', help='CSV files with profile data. Defaults to %s' % src_profile_aa)
+  parser.add_argument('--historic', action='store_true', help='Build the profiles with the data of all the years in %s instead.' % src_profile_dir)
+  parser.add_argument('--profile', metavar='FILE', help='Write the time of the traced functions as collapsed stacks to this file. Same as setting CS_PROFILE.')
+  args = parser.parse_args()
+
+  if args.profile:
+    enable(args.profile)
+
+  if args.historic:
+    main_historic()
+  else:
+    main(sources=args.sources)
\ No newline at end of file
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# This script runs the whole build of the Climatescope data: the core data,
+# the auxiliary data, the profiles and the static maps.
+#
+# The scripts are modelled as stages with dependencies. Stages that don't
+# depend on each other run at the same time, each in its own process, so they
+# don't share the GIL. The metadata is loaded once before the stages are
+# started, which inherit it. Every stage stages its output in its own scratch
+# folder, so they don't get in each other's way.
+#
+#
+# USAGE
+#
+# Example: python cs-pipeline.py
+#
+# To only run some of the stages:
+# python cs-pipeline.py --stages core auxiliary
+#
+# To run all stages but the static maps:
+# python cs-pipeline.py --skip static-maps
+#
+# To list the stages and their dependencies:
+# python cs-pipeline.py --list
+#
+# To profile the build, with a flamegraph of the stages:
+# python cs-pipeline.py --profile build.folded
+# flamegraph.pl build.folded > build.svg
+
+import argparse
+import collections
+import imp
+import multiprocessing
+import Queue
+import sys
+import time
+import traceback
+
+import settings
+from utils.meta import load_meta
+from utils.profiling import collected, enable, merge, reset, stage
+
+
+def load_script(name, path):
+  """ Load one of the scripts as a module. The scripts have dashes in their
+  names, so they can't be imported.
+  """
+  return imp.load_source(name, path)
+
+
+def run_core(workers):
+  load_script('cs_core', 'cs-core.py').main()
+
+
+def run_auxiliary(workers):
+  import cs_auxiliary
+  cs_auxiliary.main(workers=workers)
+
+
+def run_profiles(workers):
+  load_script('cs_countries_profile', 'cs-countries-profile.py').main()
+
+
+def run_static_maps(workers):
+  load_script('cs_static_maps', 'cs-static-maps.py').main(workers=workers)
+
+
+# The stages of the build, in the order they are started when they are ready,
+# with the stages they depend on.
+stages = collections.OrderedDict([
+  ('core', {'function': run_core, 'deps': []}),
+  ('auxiliary', {'function': run_auxiliary, 'deps': []}),
+  ('profiles', {'function': run_profiles, 'deps': []}),
+  ('static-maps', {'function': run_static_maps, 'deps': []})
+])
+
+
+def run_stage(name, workers, done):
+  """ Run a stage in the process of the stage and put its result on the done
+  queue, with the stacks it profiled
+  """
+  start = time.time()
+  # The stacks of the pipeline itself are written by the parent
+  reset()
+  try:
+    # The profiled stacks of this stage start with its name
+    with stage(name):
+      stages[name]['function'](workers)
+    status = 'ok'
+  except SystemExit as e:
+    # The scripts quit with sys.exit when they can't continue
+    status = 'failed' if e.code is None or e.code == 0 else 'failed (exit %s)' % e.code
+  except Exception:
+    traceback.print_exc()
+    status = 'failed'
+  done.put((name, status, start, time.time(), collected()))
+
+
+def run_pipeline(selected, workers=1):
+  """ Run the selected stages, each as soon as the stages it depends on are
+  done. Dependencies that aren't selected are considered done. A stage is
+  skipped when one of its dependencies failed.
+
+  Parameters
+  ----------
+  selected  : list
+              The names of the stages to run
+  workers   : int
+              The number of workers for the stages that support them
+
+  Returns
+  -------
+  An OrderedDict with the status, start and end time of every stage
+  """
+  results = collections.OrderedDict()
+  pending = [name for name in stages if name in selected]
+  # The process of every running stage
+  running = {}
+  done = multiprocessing.Queue()
+
+  while pending or running:
+    for name in list(pending):
+      deps = [dep for dep in stages[name]['deps'] if dep in selected]
+      if [dep for dep in deps if dep in results and results[dep]['status'] != 'ok']:
+        now = time.time()
+        results[name] = {'status': 'skipped', 'start': now, 'end': now}
+        pending.remove(name)
+      elif not [dep for dep in deps if dep not in results]:
+        print "Starting stage %s..." % (name)
+        sys.stdout.flush()
+        process = multiprocessing.Process(target=run_stage, args=(name, workers, done))
+        process.start()
+        running[name] = {'process': process, 'start': time.time()}
+        pending.remove(name)
+
+    if running:
+      try:
+        name, status, start, end, stacks = done.get(timeout=1)
+      except Queue.Empty:
+        # A stage that died without reporting (eg. killed) failed
+        for name, stage_run in running.items():
+          code = stage_run['process'].exitcode
+          if code is not None and code != 0:
+            del running[name]
+            results[name] = {'status': 'failed (exit %s)' % code, 'start': stage_run['start'], 'end': time.time()}
+            print "Stage %s: %s" % (name, results[name]['status'])
+        continue
+      running.pop(name)['process'].join()
+      merge(stacks)
+      results[name] = {'status': status, 'start': start, 'end': end}
+      print "Stage %s: %s in %.1fs" % (name, status, end - start)
+
+  return results
+
+
+def print_summary(results, start, end):
+  """ Print the timing of every stage and of the whole build
+  """
+  print "\nStage           Status      Start    Time"
+  for name in [name for name in stages if name in results]:
+    result = results[name]
+    print "%-15s %-11s %5.1fs  %5.1fs" % (name, result['status'], result['start'] - start, result['end'] - result['start'])
+
+  total = sum([r['end'] - r['start'] for r in results.values()])
+  elapsed = end - start
+  print "Built in %.1fs, the stages took %.1fs together." % (elapsed, total)
+
+
+def main(selected, workers=1):
+  start = time.time()
+
+  # Load the metadata once, the processes of the stages inherit the cache of
+  # load_meta
+  load_meta(settings.src_meta_aa, settings.src_meta_index, settings.meta_snapshot)
+  print "Loaded the metadata in %.1fs" % (time.time() - start)
+
+  results = run_pipeline(selected, workers)
+  print_summary(results, start, time.time())
+
+  if [r for r in results.values() if r['status'] != 'ok']:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Build all the data of the Climatescope.')
+  parser.add_argument('--stages', nargs='+', choices=stages.keys(), default=stages.keys(), help='The stages to run. Defaults to all of them.')
+  parser.add_argument('--skip', nargs='+', choices=stages.keys(), default=[], help='Stages not to run.')
+  parser.add_argument('--workers', type=int, default=1, help='Number of workers for the auxiliary data and the static maps.')
+  parser.add_argument('--profile', metavar='FILE', help='Write the time of the traced functions as collapsed stacks to this file, per stage. Same as setting CS_PROFILE.')
+  parser.add_argument('--list', action='store_true', help='List the stages and their dependencies and exit.')
+  args = parser.parse_args()
+
+  if args.list:
+    for name, stage in stages.items():
+      print "%s%s" % (name, ' (after %s)' % ', '.join(stage['deps']) if stage['deps'] else '')
+    sys.exit(0)
+
+  if args.profile:
+    enable(args.profile)
+
+  main([name for name in args.stages if name not in args.skip], workers=args.workers)
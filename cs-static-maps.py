@@ -3,7 +3,8 @@
 
 # This script takes the list of administrative areas provided in the meta file
 # and produces a static map in PNG format for each of them. 
-# It uses Tilemill to generate these images.
+# It uses Tilemill to generate these images, or draws them itself with PIL
+# (--renderer raster).
 #
 # Based on the original bounding box in degrees, we calculate a new bounding 
 # box for the desired height and width. By default, it scales the polygon and
@@ -18,27 +19,80 @@
 #
 # Example: python cs-static-maps.py
 #
+# To run 4 Tilemill exports at the same time:
+# python cs-static-maps.py --workers 4
+#
+# Maps are only rendered again when their bbox, style, size, padding, language
+# or the Tilemill project changed. To render all of them anyway:
+# python cs-static-maps.py --force
+#
+# To render the maps without Tilemill, straight from the shapefiles:
+# python cs-static-maps.py --renderer raster
+#
+# To also get the maps for retina screens and thumbnails, rendered once at the
+# largest scale and resized for the others:
+# python cs-static-maps.py --scales 2 1 0.25
+# Scale 1 is exported to {lang}/{iso}.png, the others to {lang}/{scale}x/{iso}.png
+#
+# To optimize the PNG's after rendering (lossless), or to also reduce maps with
+# more than 256 colors to a palette (lossy):
+# python cs-static-maps.py --optimize
+# python cs-static-maps.py --optimize --quantize
+#
+# To only print the bboxes for another size, without rendering anything:
+# python cs-static-maps.py --preview --width 1024 --height 768
+#
 #
 # Todo:
 # - check if Natural Earth shapefiles exist and if not, download them
 # - runs Tilemill in the standard Ubuntu install folder
-# - Optimize the PNG's
 
 
-import subprocess
-import shlex
+import argparse
+import hashlib
+import json
 import math
+import numpy as np
+import os
+import os.path
 import sys
-import pandas as pd
+import time
 from osgeo import ogr
 
+from utils.geometry import cache_geometries, shapefile_hash, tolerance
+from utils.meta import load_meta
+from utils.profiling import enable, traced
+from utils.progress import Progress
+from utils.optimize import optimize_images, print_savings
+from utils.raster import RasterExporter
+from utils.render import TilemillExporter, render_jobs, print_summary
+from utils.utils import scratch_dir, Staging
+
 src_meta_aa = 'source/meta/admin_areas.csv'
+src_meta_index = 'source/meta/index.csv'
+meta_snapshot = 'cache/meta.pickle'
+cache_dir = 'cache/'
+# Every run gets its own scratch folder in here
+tmp_dir = 'tmp/'
 exp_dir = 'data/assets/images/content/maps/'
+# Keeps track of the render key of every exported image
+manifest_fn = exp_dir + 'manifest.json'
+# The summaries of the renders (maps/s, slowest maps) are appended to this log
+progress_log = cache_dir + 'progress.log'
+# Keeps track of the hash of every optimized image
+optimized_fn = exp_dir + 'optimized.json'
 
 # Tilemill installation directory
 tm_dir = '/usr/share/tilemill/'
 tm_project = 'cs-single-country'
 
+# The shapefiles with the countries and states, with the attribute that
+# contains the iso code of the administrative area
+shapefiles = {
+  'c': ('source/shapefiles/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp', 'ISO_A2'),
+  's': ('source/shapefiles/ne_10m_admin_1_states_provinces/ne_10m_admin_1_states_provinces.shp', 'iso_3166_2')
+}
+
 # Languages to generate images for
 langs = ('en','es')
 
@@ -164,6 +218,74 @@ def calculate_bbox(lon1,lat1,lon2,lat2,padding=(0,0,0,0)):
   new_bbox = '"%s,%s,%s,%s"' % (new_lon1, new_lat1, new_lon2, new_lat2)
   return new_bbox
 
+def distances_on_unit_sphere(lon1, lat1, lon2, lat2):
+  "Vectorized version of distance_on_unit_sphere. Takes arrays of coordinates and returns an array with the arcs."
+  degrees_to_radians = np.pi/180.0
+
+  phi1 = (90.0 - lat1)*degrees_to_radians
+  phi2 = (90.0 - lat2)*degrees_to_radians
+  theta1 = lon1*degrees_to_radians
+  theta2 = lon2*degrees_to_radians
+
+  cos = (np.sin(phi1)*np.sin(phi2)*np.cos(theta1 - theta2) +
+         np.cos(phi1)*np.cos(phi2))
+  return np.arccos(cos)
+
+def calculate_bboxes(envelopes,width,height,padding=(0,0,0,0)):
+  "Vectorized version of calculate_bbox. Takes a list with an envelope (minx, maxx, miny, maxy) per area and returns an array with the new bbox (lon1, lat1, lon2, lat2) of each of them."
+  env = np.asarray(envelopes, dtype=float).reshape(-1, 4)
+  lon1 = env[:,0]
+  lon2 = env[:,1]
+  lat1 = env[:,2]
+  lat2 = env[:,3]
+
+  # The desired core bounding box, removing the optional padding.
+  core_width = float(width - padding[1] - padding[3])
+  core_height = float(height - padding[0] - padding[2])
+
+  degrees_lon = lon2 - lon1
+  degrees_lat = lat2 - lat1
+  center_lat = degrees_lat / 2 + lat1
+
+  length_lat = distances_on_unit_sphere(lon1, lat1, lon1, lat2)
+  length_lon = distances_on_unit_sphere(lon1, center_lat, lon2, center_lat)
+
+  # Both cases are calculated for all areas, the one that doesn't apply may
+  # divide by zero (eg. for a single point).
+  with np.errstate(divide='ignore', invalid='ignore'):
+    # Wide shapes fit the core box on the longitudes and get space added to
+    # the top and bottom, narrow shapes the other way around.
+    wide = core_width / core_height < length_lon / length_lat
+
+    # Wide shapes
+    px_distance_lat = core_width / length_lon * length_lat
+    wide_px_per_degree_lon = core_width / degrees_lon
+    wide_px_per_degree_lat = px_distance_lat / degrees_lat
+    wide_shift_lat = (core_height - px_distance_lat) / 2 / wide_px_per_degree_lat
+
+    # Narrow shapes
+    px_distance_lon = core_height / length_lat * length_lon
+    narrow_px_per_degree_lon = px_distance_lon / degrees_lon
+    narrow_px_per_degree_lat = core_height / degrees_lat
+    narrow_shift_lon = (core_width - px_distance_lon) / 2 / narrow_px_per_degree_lon
+
+    px_per_degree_lon = np.where(wide, wide_px_per_degree_lon, narrow_px_per_degree_lon)
+    px_per_degree_lat = np.where(wide, wide_px_per_degree_lat, narrow_px_per_degree_lat)
+    shift_core_lon = np.where(wide, 0, narrow_shift_lon)
+    shift_core_lat = np.where(wide, wide_shift_lat, 0)
+
+    bboxes = np.empty((len(env), 4))
+    bboxes[:,0] = lon1 - shift_core_lon - padding[3] / px_per_degree_lon
+    bboxes[:,1] = center_lat - shift_core_lat - padding[2] / px_per_degree_lat
+    bboxes[:,2] = lon2 + shift_core_lon + padding[1] / px_per_degree_lon
+    bboxes[:,3] = center_lat + shift_core_lat + padding[0] / px_per_degree_lat
+
+  return bboxes
+
+def format_bbox(bbox):
+  "Format a bbox (lon1, lat1, lon2, lat2) the way calculate_bbox returns it."
+  return '"%s,%s,%s,%s"' % tuple([float(v) for v in bbox])
+
 def generate_cartocss(aa_type,active,lang):
   "Write the stylesheet for the map. Type = country or state, active = the iso of the active area, lang = language"
   if aa_type == 'c':
@@ -197,16 +319,93 @@ def generate_cartocss(aa_type,active,lang):
 
   return cartocss_template
 
-def build_set(search,search_col,result,csv):
-  "Build a set from a CSV file, iterating over rows and storing the value of 'result' column when the 'search' is found in the 'search_col'."
-  df = pd.read_csv(csv)
-  s = set()
-  for index, row in df.iterrows():
-    if row[search_col] == search:
-      s.add(row[result])
-  return s
+@traced
+def get_envelopes(shp, attribute, isos, shp_hash=None):
+  """Return a dict with the envelope (minx, maxx, miny, maxy) of the areas in isos. The envelopes are cached per shapefile hash, so the shapefile is only opened for areas that were never looked up before. Only the features of those areas are read, by filtering on the attribute in OGR. The hash itself is stored by the size and modification time of the shapefile, so it's only calculated again when the shapefile changed."""
+  if shp_hash is None:
+    shp_hash = shapefile_hash(shp, cache_dir)
+  cache_fn = '%senvelopes-%s.json' % (cache_dir, shp_hash)
+  if os.path.exists(cache_fn):
+    with open(cache_fn) as ifile:
+      cache = json.load(ifile)
+  else:
+    cache = {'envelopes': {}, 'missing': []}
 
-def main():
+  todo = sorted([iso for iso in isos if iso not in cache['envelopes'] and iso not in cache['missing']])
+  if todo:
+    ds = ogr.Open(shp)
+    lyr = ds.GetLayer(0)
+    # Let OGR select the features of the areas we need
+    lyr.SetAttributeFilter("%s IN (%s)" % (attribute, ', '.join(["'%s'" % iso.replace("'", "''") for iso in todo])))
+    lyr.ResetReading()
+    feature = lyr.GetNextFeature()
+    while feature is not None:
+      # Get bbox in minx, maxx, miny, maxy format
+      cache['envelopes'][feature.GetField(attribute)] = list(feature.GetGeometryRef().GetEnvelope())
+      feature = lyr.GetNextFeature()
+    cache['missing'] += [iso for iso in todo if iso not in cache['envelopes']]
+
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    # Write to a temporary file first, so other runs never read half a cache
+    # file
+    tmp_fn = '%s.%s' % (cache_fn, os.getpid())
+    with open(tmp_fn, 'w') as ofile:
+      json.dump(cache, ofile)
+    os.rename(tmp_fn, cache_fn)
+
+  return dict((iso, cache['envelopes'][iso]) for iso in isos if iso in cache['envelopes'])
+
+def get_project_style():
+  "Return the project definition of the Tilemill project, or an empty string if it doesn't exist."
+  fn = './tilemill/project/' + tm_project + '/project.mml'
+  if not os.path.exists(fn):
+    return ''
+  with open(fn) as ifile:
+    return ifile.read()
+
+def render_key(job, project_style):
+  "Return a hash of everything that determines the image of a render job."
+  h = hashlib.sha1()
+  parts = [job['renderer'], job['bbox'], job['cartocss'], job['width'], job['height'], job['padding'], job['lang'], project_style]
+  # The scales only count when there are other ones than 1, so the keys of maps
+  # that were only exported at scale 1 stay the same
+  if job['scale'] != 1 or len(job['variants']) > 1:
+    parts.append((job['scale'], job['variants']))
+  for part in parts:
+    h.update(repr(part))
+  return h.hexdigest()
+
+def load_manifest():
+  "Load the render keys of the images that were exported before."
+  if not os.path.exists(manifest_fn):
+    return {}
+  with open(manifest_fn) as ifile:
+    return json.load(ifile)
+
+def save_manifest(manifest, staging):
+  "Store the render keys of the exported images next to them."
+  with open(staging.path(manifest_fn), 'w') as ofile:
+    json.dump(manifest, ofile, indent=2, sort_keys=True)
+
+def get_capitals(meta):
+  "Return the capital of every admin area with a location as (lon, lat, {lang: name})."
+  capitals = {}
+  for aa in meta.admin_areas.values():
+    if aa.lat is not None and aa.lon is not None:
+      capitals[aa.iso] = (float(aa.lon), float(aa.lat), aa.capital)
+  return capitals
+
+def scale_output(lang, iso, scale):
+  "Return the path of the image of an area at a scale."
+  if scale == 1:
+    return '%s%s/%s.png' % (exp_dir, lang, iso.lower())
+  return '%s%s/%gx/%s.png' % (exp_dir, lang, scale, iso.lower())
+
+@traced
+def main(workers=1, force=False, preview=False, renderer='tilemill', scales=(1,), optimize=False, quantize=False):
+  # The largest scale first, that's the one that is rendered
+  scales = sorted(set(scales), reverse=True)
 
   if height < (padding[0] + padding[2]):
     print "ABORT. ABORT.\n"\
@@ -218,59 +417,150 @@ def main():
     sys.exit(0)
 
   # Build the lists with countries and states to generate a map for.  
-  countries = build_set('country','type','iso',src_meta_aa)
-  states = build_set('state','type','iso',src_meta_aa)
+  meta = load_meta(src_meta_aa, src_meta_index, meta_snapshot)
+  countries = set(meta.areas('country'))
+  states = set(meta.areas('state'))
   
+  # Hash the shapefiles once, the envelopes and the simplified geometries are
+  # cached by these hashes
+  hashes = dict((aa, shapefile_hash(shp, cache_dir)) for aa, (shp, attribute) in shapefiles.items())
+
+  # The maps to render
+  jobs = []
+
   # Country are treated slightly different than states and provinces.
   for aa in 'c','s':
+    shp, attribute = shapefiles[aa]
     if aa == 'c':
-      shp = 'source/shapefiles/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
-      # The attribute in the shapefile containing the iso code of the administrative area
-      attribute = 'ISO_A2'
       admin_areas = countries
     else:
-      shp = 'source/shapefiles/ne_10m_admin_1_states_provinces/ne_10m_admin_1_states_provinces.shp'
-      attribute = 'iso_3166_2'
       admin_areas = states
-    
-    ds = ogr.Open(shp)
-    lyr = ds.GetLayer(0)
-    lyr.ResetReading()
-    count = lyr.GetFeatureCount()
-
-    for i in range(count):
-      feature = lyr.GetFeature(i)
-      iso = feature.GetField(attribute)
-      if iso in admin_areas:
-
-        # Get bbox in minx, maxx, miny, maxy format
-        env = feature.GetGeometryRef().GetEnvelope()
-        
-        # SW = lon1, lat1 (min)
-        lon1 = env[0]
-        lat1 = env[2]
-        # NE = lon2, lat2 (max)
-        lon2 = env[1]
-        lat2 = env[3]
-
-        # Get the new bbox for the desired size in px.
-        new_bbox = calculate_bbox(lon1,lat1,lon2,lat2,padding)
-
-        for lang in langs:
-          # Make sure we highlight the correct country
-          cartocss_template = generate_cartocss(aa,iso,lang)
-          
-          with open('./tilemill/project/' + tm_project + '/style.mss','w') as mss:
-            mss.write(cartocss_template)
 
+    envelopes = get_envelopes(shp, attribute, admin_areas, hashes[aa])
+    isos = sorted(envelopes)
+
+    # Get the new bboxes for the desired size in px, for all areas at once.
+    bboxes = calculate_bboxes([envelopes[iso] for iso in isos],width,height,padding)
+
+    for iso, bbox in zip(isos, bboxes):
+      new_bbox = format_bbox(bbox)
+
+      if preview:
+        print "%s\t%s" % (iso, new_bbox)
+        continue
+
+      for lang in langs:
+        # The variant at the largest scale is rendered, the others are
+        # resized from it. The bbox doesn't depend on the scale.
+        variants = [(scale, scale_output(lang, iso, scale)) for scale in scales]
+        jobs.append({
+          'iso': iso,
+          'lang': lang,
+          'aa_type': aa,
+          'renderer': renderer,
+          'bbox': new_bbox,
+          'bbox_coords': tuple([float(v) for v in bbox]),
+          # Make sure we highlight the correct country
+          'cartocss': generate_cartocss(aa,iso,lang),
           # For the file export, we want the iso code lowercase
-          iso_fn = iso.lower()
-
-          # Build the export command
-          command = "node %sindex.js export %s %s%s/%s.png --format=png --width=%s --height=%s --bbox=%s --files='tilemill'" % (tm_dir, tm_project, exp_dir, lang, iso_fn, width, height, new_bbox)
-          # shlex makes sure that all arguments are correctly passed, most notably the bounding box
-          args = shlex.split(command)
-          subprocess.call(args)
+          'output': variants[0][1],
+          'variants': variants,
+          # The pixel density of the export, the size and padding are at scale 1
+          'scale': scales[0],
+          # The simplification tolerance of the geometries for the raster renderer
+          'tolerance': tolerance(bbox, int(round(width * scales[0]))),
+          'width': width,
+          'height': height,
+          'padding': padding
+        })
+
+  if preview:
+    return
+
+  # Skip the maps for which an image with the same render key exists
+  manifest = load_manifest()
+  project_style = get_project_style()
+  to_render = []
+  for job in jobs:
+    job['key'] = render_key(job, project_style)
+    paths = [output for scale, output in job['variants']]
+    if not force and all([manifest.get(os.path.relpath(path, exp_dir)) == job['key'] and os.path.exists(path) for path in paths]):
+      continue
+    to_render.append(job)
+  print "%s of %s maps are up to date." % (len(jobs) - len(to_render), len(jobs))
+
+  # The maps are rendered into a staging area in the scratch folder of this
+  # run, and only moved into the export folder when they are all done. The
+  # scratch folder is removed when the run ends, also when it fails.
+  with scratch_dir('cs-static-maps-', tmp_dir) as d:
+    staging = Staging(exp_dir, d)
+    for job in to_render:
+      job['variants'] = [(scale, staging.path(output)) for scale, output in job['variants']]
+      job['output'] = job['variants'][0][1]
+
+    # Render the maps, each worker with its own copy of the Tilemill project or
+    # its own simplified geometries
+    if renderer == 'raster':
+      exporter = RasterExporter(shapefiles, get_capitals(meta), cache_dir, hashes)
+      # Simplify the geometries the maps need before the workers start, so they
+      # only have to load them
+      start = time.time()
+      tolerances = sorted(set([(job['aa_type'], job['tolerance']) for job in to_render]))
+      for aa_type, tol in tolerances:
+        shp, attribute = shapefiles[aa_type]
+        cache_geometries(shp, attribute, tol, cache_dir, hashes[aa_type])
+      print "Prepared %s simplified geometry sets in %.1fs." % (len(tolerances), time.time() - start)
+    else:
+      exporter = TilemillExporter(tm_dir, tm_project)
+    start = time.time()
+    progress = Progress('Static maps', len(to_render), progress_log)
+    results = render_jobs(to_render, exporter, workers, progress)
+    print_summary(results, time.time() - start)
+    progress.finish()
+
+    # Only store the keys of the maps that were exported successfully. What
+    # failed exports left behind isn't moved into the export folder.
+    for r in results:
+      for scale, output in r['job']['variants']:
+        path = os.path.relpath(output, staging.dir)
+        if r['code'] == 0:
+          manifest[path] = r['job']['key']
+        else:
+          manifest.pop(path, None)
+          if os.path.exists(output):
+            os.remove(output)
+    save_manifest(manifest, staging)
+    staging.commit()
+
+  # Optimize all exported maps that changed since they were last optimized
+  if optimize:
+    start = time.time()
+    optimized = optimize_images([exp_dir + path for path in sorted(manifest)], optimized_fn, exp_dir, workers, quantize)
+    print "Optimized %s maps in %.1fs." % (len(optimized), time.time() - start)
+    print_savings(optimized, exp_dir)
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  parser = argparse.ArgumentParser(description='Generate the static maps of the countries and states.')
+  parser.add_argument('--workers', type=int, default=1, help='Number of maps to render at the same time.')
+  parser.add_argument('--force', action='store_true', help='Render all maps, even the ones that are up to date.')
+  parser.add_argument('--renderer', choices=['tilemill', 'raster'], default='tilemill', help='Render the maps with Tilemill or draw them with PIL.')
+  parser.add_argument('--scales', type=float, nargs='+', default=[1], help='Scales to export the maps at (eg. 2 1 0.5).')
+  parser.add_argument('--optimize', action='store_true', help='Optimize the PNG\'s after rendering.')
+  parser.add_argument('--quantize', action='store_true', help='When optimizing, reduce maps with more than 256 colors to a palette (lossy).')
+  parser.add_argument('--preview', action='store_true', help='Only print the bbox of every map, without rendering.')
+  parser.add_argument('--width', type=int, default=width, help='Width of the maps in px.')
+  parser.add_argument('--height', type=int, default=height, help='Height of the maps in px.')
+  parser.add_argument('--padding', type=int, nargs=4, default=padding, metavar=('TOP', 'RIGHT', 'BOTTOM', 'LEFT'), help='Padding of the maps in px.')
+  parser.add_argument('--profile', metavar='FILE', help='Write the time of the traced functions as collapsed stacks to this file. Same as setting CS_PROFILE.')
+  args = parser.parse_args()
+
+  if args.profile:
+    enable(args.profile)
+
+  width = args.width
+  height = args.height
+  padding = tuple(args.padding)
+  if min(args.scales) <= 0:
+    parser.error('The scales have to be larger than 0.')
+
+  main(workers=args.workers, force=args.force, preview=args.preview, renderer=args.renderer, scales=args.scales, optimize=args.optimize, quantize=args.quantize)
\ No newline at end of file
@@ -15,10 +15,29 @@
 # USAGE
 #
 # Example: python cs-auxiliary.py
+#
+# To print the execution plan without building anything:
+# python cs_auxiliary.py --plan
+#
+# To render the charts on a pool of 4 processes:
+# python cs_auxiliary.py --workers 4
+#
+# To build every edition in the source folder in a single run:
+# python cs_auxiliary.py --all-editions
+#
+# To only write the areas with data for a chart, plus an index.json per chart:
+# python cs_auxiliary.py --sparse
+#
+# To also write the documents of all areas in one file per chart:
+# python cs_auxiliary.py --bundle chart
 
 
 import sys
 import os
+import argparse
+import multiprocessing
+import time
+import re
 import os.path
 import csv
 import pandas as pd
@@ -27,141 +46,720 @@ import shutil
 import json
 
 import settings
-from utils.utils import check_dir, clean_dir, check_create_folder, write_json
+from utils.utils import scratch_dir, Staging, write_json
+from utils.meta import load_meta
+from utils.profiling import enable, traced
+from utils.progress import Progress
 
 
-def get_aa_list():
-  """  Returns a list of iso codes for the states and countries from the admin_areas.csv
+def get_aa_regions(meta):
+  """ Returns a dict with the region of every country and state. States take
+  the region of their country.
   """
-  aareas = [];
-  ifile = csv.DictReader(open(settings.src_meta_aa))
-  for row in ifile:
-    if row["type"] == 'country' or row["type"] == 'state':
-      aareas.append(row["iso"].strip())
-  return aareas
+  return dict((aa, meta.region(aa)) for aa in meta.areas('country', 'state'))
 
 
-def get_avg(chart, ind_source):
-  """ Generate the global averages for this indicator.
-  It returns an object with averages for all the series and all the years
+@traced
+def get_averages(table, aa_regions):
+  """ Calculate the global and regional averages for all the series and years
+  of a source in one pass. Areas without a value are left out of the average.
+  The global average includes every row of the source, the regional averages
+  only the areas with a region in aa_regions.
+  Returns a dict with the global averages as a serie x year array and the
+  regional averages as a dict of serie x year arrays, keyed by region.
+
+  Parameters
+  ----------
+  table     : dict
+              The dense table of the source, see load_table()
+  aa_regions: dict
+              The region of every admin area, see get_aa_regions()
   """
-  avg = {}
-  ind_data = pd.read_csv(ind_source)
+  values = table["values"]
+  valid = ~np.isnan(values)
+  filled = np.where(valid, values, 0)
 
-  grouped_data = ind_data.groupby(['sub_indicator']).mean()
+  # Region of every area in the table, -1 when it doesn't have one
+  regions = sorted(set([region for region in aa_regions.values() if region]))
+  region_index = dict((region, i) for i, region in enumerate(regions))
+  codes = np.empty(len(table["isos"]), dtype=int)
+  for iso, i in table["isos"].items():
+    codes[i] = region_index.get(aa_regions.get(iso), -1)
+  in_region = codes >= 0
 
-  for serie in chart["series"]:
-    source_id = serie["source-id"]
-    serie_avg = {}
-    for yr in chart["years"]:
-      serie_avg.update({yr: grouped_data.ix[source_id,str(yr)]})
-    avg.update({source_id: serie_avg})
-  
-  return avg
+  sums = np.zeros((len(regions),) + values.shape[1:])
+  counts = np.zeros((len(regions),) + values.shape[1:])
+  np.add.at(sums, codes[in_region], filled[in_region])
+  np.add.at(counts, codes[in_region], valid[in_region])
+
+  with np.errstate(invalid='ignore', divide='ignore'):
+    global_avg = filled.sum(axis=0) / valid.sum(axis=0)
+    regional_avg = sums / counts
+
+  return {
+    "global": global_avg,
+    "regions": dict((region, regional_avg[i]) for region, i in region_index.items())
+  }
+
+
+def chart_averages(chart, source_avg, aa_regions):
+  """ Select the averages of a source that are attached to a chart. Returns
+  False if the chart doesn't show any averages.
+  """
+  averages = {}
+  if "global_average" in chart and chart["global_average"]:
+    averages["global"] = source_avg["global"]
+  if "regional_average" in chart and chart["regional_average"]:
+    averages["regions"] = source_avg["regions"]
+    averages["aa_regions"] = aa_regions
+  return averages or False
+
+
+def parse_values(col):
+  """ Parse a column of strings to floats. Values that are not numeric become
+  NaN. The validity check is vectorized, the conversion itself goes through
+  float() so the values match the ones parsed from the CSV row by row.
+  """
+  col = col.str.strip()
+  valid = pd.to_numeric(col, errors='coerce').notnull()
+  return col.where(valid, 'nan').astype(float)
+
+
+def read_source(ind_source):
+  """ Read an auxiliary CSV into a frame of strings. Sources that pandas can't
+  parse (eg. the unterminated quote in 2016-102.csv) are read row by row with
+  csv.DictReader instead, which is how they were always read.
+  """
+  try:
+    return pd.read_csv(ind_source, dtype=str, keep_default_na=False)
+  except ValueError as e:
+    print "%s could not be parsed with pandas (%s), reading it row by row." % (ind_source, str(e).strip())
+    with open(ind_source) as ifile:
+      reader = csv.DictReader(ifile)
+      rows = list(reader)
+    # Cells missing from short rows are empty, like in the frame of pandas
+    return pd.DataFrame(rows, columns=reader.fieldnames).fillna('')
+
+
+@traced
+def load_table(ind_source):
+  """ Pivot an auxiliary CSV into dense arrays over iso x serie x year.
+  The series are identified by the sub_chain column when the source has one
+  (value chains), otherwise by sub_indicator. Cells that can't be parsed as a
+  number are stored as NaN. Notes are kept in a parallel iso x serie array.
+
+  Parameters
+  ----------
+  ind_source: string
+              Path to the auxiliary CSV file
+  """
+  ind_data = read_source(ind_source)
+
+  if 'sub_chain' in ind_data.columns:
+    key_col = 'sub_chain'
+  else:
+    key_col = 'sub_indicator'
+
+  ind_data['iso'] = ind_data['iso'].str.strip(' ')
+  ind_data[key_col] = ind_data[key_col].str.strip()
+  # Only the first row for an area and serie is taken into account
+  ind_data = ind_data.drop_duplicates(subset=['iso', key_col])
+
+  yr_cols = [col for col in ind_data.columns if re.match('^[0-9]{4}$', col)]
+
+  iso_codes, isos = pd.factorize(ind_data['iso'])
+  id_codes, ids = pd.factorize(ind_data[key_col])
+
+  # Vectorized parse of all the yearly values
+  parsed = ind_data[yr_cols].apply(parse_values)
+
+  values = np.full((len(isos), len(ids), len(yr_cols)), np.nan)
+  values[iso_codes, id_codes, :] = parsed.values
+
+  present = np.zeros((len(isos), len(ids)), dtype=bool)
+  present[iso_codes, id_codes] = True
+
+  notes = np.empty((len(isos), len(ids)), dtype=object)
+  if 'note' in ind_data.columns:
+    notes[iso_codes, id_codes] = ind_data['note'].values
+
+  return {
+    'source': ind_source,
+    'key': key_col,
+    'isos': dict((iso, i) for i, iso in enumerate(isos)),
+    'ids': dict((source_id, i) for i, source_id in enumerate(ids)),
+    'years': dict((int(yr), i) for i, yr in enumerate(yr_cols)),
+    'values': values,
+    'present': present,
+    'notes': notes
+  }
+
+
+def get_cell(table, aa, source_id):
+  """ Returns the position of an area and serie in the table, or None when
+  the source doesn't contain a row for them.
+  """
+  i = table['isos'].get(aa)
+  j = table['ids'].get(source_id.strip())
+  if i is None or j is None or not table['present'][i, j]:
+    return None
+  return i, j
+
+
+def take_years(table, row, years):
+  """ Select the requested years from an array over the years of the table.
+  Years that are not in the source are NaN.
+  """
+  yr_index = [table['years'].get(yr) for yr in years]
+  values = np.full(len(years), np.nan)
+  found = [k for k, pos in enumerate(yr_index) if pos is not None]
+  if found:
+    values[found] = row[[yr_index[k] for k in found]]
+  return values
 
 
-def default_chart(serie, ind_source, lang, aa, years, global_avg):
+def slice_values(table, aa, source_id, years):
+  """ Returns a list with the values of a serie for the requested years, as
+  floats. Missing values fall back to the int 0, like the CSV reader did.
+  Returns None if the area has no data for the serie.
+  """
+  cell = get_cell(table, aa, source_id)
+  if cell is None:
+    return None
+
+  values = take_years(table, table['values'][cell], years)
+  return [0 if np.isnan(v) else float(v) for v in values]
+
+
+def slice_averages(table, averages, aa, source_id, years):
+  """ Returns the global and regional averages of a serie for the requested
+  years. Either is None when the chart doesn't show it.
+  """
+  global_avg = None
+  regional_avg = None
+  j = table['ids'].get(source_id.strip())
+
+  if "global" in averages:
+    if j is None:
+      global_avg = np.full(len(years), np.nan)
+    else:
+      global_avg = take_years(table, averages["global"][j], years)
+
+  if "regions" in averages:
+    region = averages["aa_regions"].get(aa)
+    if j is None or region not in averages["regions"]:
+      regional_avg = np.full(len(years), np.nan)
+    else:
+      regional_avg = take_years(table, averages["regions"][region][j], years)
+
+  return global_avg, regional_avg
+
+
+@traced
+def default_chart(serie, table, lang, aa, years, averages):
   """ Generate the data for the charts in the default structure
   """
-  # Read in the CSV file
-  ind_data = csv.DictReader(open(ind_source))
   data = []
+  values = slice_values(table, aa, serie["source-id"], years)
+  if values is None:
+    return data
 
-  for row in ind_data:
-    if aa == row["iso"].strip(' ') and serie["source-id"].strip() == row["sub_indicator"].strip():
-      for yr in years:
-        avg = None
-        if global_avg:
-          avg = global_avg[serie["source-id"]][yr]
-        try:
-          yr_to_append = {"year": yr, "value": float(row[str(yr)]), "global_average": avg}
-        except ValueError:
-          yr_to_append = {"year": yr, "value": 0, "global_average": avg}
-        data.append(yr_to_append)
+  global_avg = None
+  regional_avg = None
+  if averages:
+    global_avg, regional_avg = slice_averages(table, averages, aa, serie["source-id"], years)
+
+  for k, yr in enumerate(years):
+    yr_to_append = {"year": yr, "value": values[k], "global_average": None}
+    if global_avg is not None:
+      yr_to_append["global_average"] = float(global_avg[k])
+    if regional_avg is not None:
+      yr_to_append["regional_average"] = float(regional_avg[k])
+    data.append(yr_to_append)
   return data
 
-def add_note(serie, ind_source, aa):
+def add_note(serie, table, aa):
   """ Add a note to the serie
   """
-  # Read in the CSV file
-  ind_data = csv.DictReader(open(ind_source))
-  data = []
-  for row in ind_data:
-    if aa == row["iso"].strip(' ') and serie["source-id"].strip() == row["sub_indicator"].strip():
-      try:
-        return row["note"]
-      except KeyError:
-        return None
-
-def value_chains(serie, ind_source, lang, aa, years, global_avg):
+  cell = get_cell(table, aa, serie["source-id"])
+  if cell is None:
+    return None
+  return table['notes'][cell]
+
+@traced
+def value_chains(serie, table, lang, aa, years, averages):
   """ The chart data for the value chain
   """
-  # Read in the CSV file
   data = []
   for sc in serie["subchains"]:
-    # Very lengthy. Check better way.
-    ind_data = csv.DictReader(open(ind_source))
-    for row in ind_data:
-      if aa == row["iso"].strip(' ') and sc["source-id"].strip() == row["sub_chain"].strip():
-        for yr in years:
-          sc_to_append = {"year": yr, "name": sc["name"][lang], "active": bool(int(row[str(yr)]))}
-          data.append(sc_to_append)
+    values = slice_values(table, aa, sc["source-id"], years)
+    if values is None:
+      continue
+    for yr, value in zip(years, values):
+      sc_to_append = {"year": yr, "name": sc["name"][lang], "active": bool(int(value))}
+      data.append(sc_to_append)
   return data
 
 
-def main():
+def get_source_ids(chart):
+  """ Returns the ids of all the rows in the source a chart is built from
+  """
+  source_ids = []
+  for serie in chart["series"]:
+    if "subchains" in serie:
+      source_ids += [sc["source-id"].strip() for sc in serie["subchains"]]
+    else:
+      source_ids.append(serie["source-id"].strip())
+  return source_ids
+
+
+def get_chart_areas(chart, table):
+  """ Returns the set of iso codes that have at least one row for the chart
+  """
+  cols = [table["ids"][source_id] for source_id in get_source_ids(chart) if source_id in table["ids"]]
+  has_data = table["present"][:, cols].any(axis=1)
+  return set([iso for iso, i in table["isos"].items() if has_data[i]])
+
+
+def get_source(chart, edition):
+  """ Returns the path to the source CSV of a chart for an edition
+  """
+  return settings.src_auxiliary + str(edition) + '-' + str(chart["id"]) + '.csv'
+
+
+def get_editions():
+  """ Returns a sorted list with the editions there is auxiliary data for. To
+  determine this, the names of the files in the source folder are checked for
+  a properly formatted edition and chart id (eg. 2016-107.csv)
+  """
+  fn_pattern = re.compile('^(20[0-9]{2})-[0-9]+\.csv$')
+  editions = set()
+  for f in os.listdir(settings.src_auxiliary):
+    match = fn_pattern.match(f)
+    if match:
+      editions.add(int(match.group(1)))
+  return sorted(editions)
+
+
+# Parsed sources, shared by all the editions and charts built in a run
+table_cache = {}
+header_cache = {}
+
+
+def get_table(ind_source):
+  """ Returns the dense table for a source, parsing it only once per run
+  """
+  if ind_source not in table_cache:
+    table_cache[ind_source] = load_table(ind_source)
+  return table_cache[ind_source]
+
+
+def get_source_years(ind_source):
+  """ Returns the years in the header of a source, without parsing the rows
+  """
+  if ind_source not in header_cache:
+    with open(ind_source) as ifile:
+      header = next(csv.reader(ifile))
+    header_cache[ind_source] = [int(col) for col in header if re.match('^[0-9]{4}$', col.strip())]
+  return header_cache[ind_source]
+
+
+def plan_charts(charts, edition, admin_areas, langs, archive=False, sparse=False, bundle=None):
+  """ Compile the chart configs into an execution plan. Charts are grouped by
+  their source file, so every source is loaded and aggregated only once before
+  its charts are rendered and written.
+  Returns a list of steps, one for each source, in order of appearance.
+
+  The years in the chart configs refer to the current edition. When building
+  an archived edition, they are shifted by the difference in editions and
+  limited to the years available in the source. Charts without a source for
+  the edition are left out.
+
+  Parameters
+  ----------
+  charts    : list
+              The chart configs (eg. settings.charts)
+  edition   : int
+              The edition to build the charts for
+  admin_areas: list
+              The iso codes of the areas to render every chart for
+  langs     : list
+              The languages to render every chart in
+  archive   : boolean (optional, default = False)
+              When set to True, the output is written to edition-scoped paths
+              and sources that fail to load are skipped.
+  sparse    : boolean (optional, default = False)
+              When set to True, only the areas that have data for a chart are
+              written, together with an index of those areas.
+  bundle    : string (optional, default = None)
+              Also write the documents of all areas in one file per chart and
+              language ('chart'), or one file per region ('region').
+  """
+  steps = []
+  by_source = {}
+
+  for chart in charts:
+    ind_source = get_source(chart, edition)
+
+    if archive:
+      if not os.path.exists(ind_source):
+        continue
+      shift = edition - settings.current_edition
+      available = get_source_years(ind_source)
+      years = [yr + shift for yr in chart["years"] if yr + shift in available]
+      if not years:
+        continue
+      # Copy the config, so the years of the current edition stay intact
+      chart = dict(chart, years=years)
+
+    if ind_source not in by_source:
+      step = {
+        "source": ind_source,
+        "edition": edition,
+        "charts": [],
+        # The averages any of the charts of this source needs
+        "aggregate": {"global": False, "regional": False},
+        "admin_areas": admin_areas,
+        "langs": langs,
+        "archive": archive,
+        "sparse": sparse,
+        "export": settings.exp_aux_json_edition if archive else settings.exp_aux_json,
+        "index": settings.exp_aux_index_edition if archive else settings.exp_aux_index,
+        "bundle": bundle,
+        "bundle_export": settings.exp_aux_bundle_edition if archive else settings.exp_aux_bundle
+      }
+      by_source[ind_source] = step
+      steps.append(step)
+    step = by_source[ind_source]
+    step["charts"].append(chart)
+
+    if "global_average" in chart and chart["global_average"]:
+      step["aggregate"]["global"] = True
+    if "regional_average" in chart and chart["regional_average"]:
+      step["aggregate"]["regional"] = True
+
+  return steps
+
+
+def print_plan(plan):
+  """ Print the execution plan with the I/O budget of every stage
+  """
+  total_bytes = 0
+  total_files = 0
+
+  for step in plan:
+    if os.path.exists(step["source"]):
+      size = os.path.getsize(step["source"])
+    else:
+      size = 0
+    total_bytes += size
+
+    n_docs = len(step["charts"]) * len(step["admin_areas"]) * len(step["langs"])
+    total_files += n_docs
+
+    print "%s (edition %s)" % (step["source"], step["edition"])
+    print "  load       1 read (%.1f KB)" % (size / 1024.0)
+    aggregates = [name for name in ("global", "regional") if step["aggregate"][name]]
+    if aggregates:
+      print "  aggregate  %s averages, one pass over the table" % ' and '.join(aggregates)
+    else:
+      print "  aggregate  -"
+    print "  render     %s charts x %s areas x %s langs = %s documents" % (len(step["charts"]), len(step["admin_areas"]), len(step["langs"]), n_docs)
+    if step["sparse"]:
+      print "  write      at most %s files + %s indexes (%s)" % (n_docs, len(step["charts"]) * len(step["langs"]), ', '.join([chart["export"] for chart in step["charts"]]))
+    else:
+      print "  write      %s files (%s)" % (n_docs, ', '.join([chart["export"] for chart in step["charts"]]))
+    if step["bundle"] == 'chart':
+      print "  bundle     %s files, one per chart and language" % (len(step["charts"]) * len(step["langs"]))
+    elif step["bundle"] == 'region':
+      print "  bundle     one file per chart, language and region"
+
+  print "Total: %s reads (%.1f KB), %s files written" % (len(plan), total_bytes / 1024.0, total_files)
+
+
+@traced
+def build_chart(chart, table, aa, lang, averages):
+  """ Render the document for a chart, admin area and language
+  """
+  iso = aa.lower()
+
+  # Initialize the array that will be written to JSON
+  json_data = {"name": iso, "iso": iso, "meta": {"title": chart["title"][lang], "label-x": chart["labelx"][lang], "label-y": chart["labely"][lang]}, "data": []}
+
+  for serie in chart["series"]:
+    if serie["id"] == 'country':
+      # If we're dealing with a country, use the country name as label of serie
+      serie_name = aa
+    else:
+      serie_name = serie["name"][lang]
+
+    # Initialize the object for the serie    
+    serie_to_append = {"name": serie_name, "id": serie["id"], "values": []}
+
+    # Add a note to the serie
+    if chart["note"]:
+      serie_to_append["note"] = add_note(serie, table, aa)
+
+    # Generate the actual data
+    serie_to_append["values"] = chart['function'](serie, table, lang, aa, chart["years"],averages)
+
+    json_data["data"].append(serie_to_append)
+
+  return json_data
+
+
+# The plan, tables and averages shared with the worker processes. They are
+# loaded before the pool is started, so forked workers inherit them.
+shared = {}
+
+
+@traced
+def load_plan(plan):
+  """ Run the load and aggregate stages of the plan. The results are stored in
+  the shared dict, indexed like the steps of the plan.
+  """
+  shared["plan"] = plan
+  shared["tables"] = []
+  shared["avgs"] = []
+  meta = load_meta(settings.src_meta_aa, settings.src_meta_index, settings.meta_snapshot)
+  shared["aa_regions"] = get_aa_regions(meta)
+
+  for step in plan:
+    # Load the source in a dense table that is sliced for every area
+    try:
+      table = get_table(step["source"])
+    except ValueError as e:
+      if not step["archive"]:
+        raise
+      # Archived sources are not maintained anymore. Don't let a broken one
+      # stop the build of the other editions.
+      print "Skipping %s, it could not be parsed: %s" % (step["source"], e)
+      shared["tables"].append(None)
+      shared["avgs"].append(False)
+      continue
+    shared["tables"].append(table)
+
+    # Calculate the averages once for all the charts of this source
+    source_avg = False
+    if step["aggregate"]["global"] or step["aggregate"]["regional"]:
+      source_avg = get_averages(table, shared["aa_regions"])
+    shared["avgs"].append(source_avg)
+
+
+def get_units(plan):
+  """ Returns the list of (step, chart, area, lang) units to render, in a
+  deterministic order. Steps and charts are referenced by their index.
+  Steps whose source could not be loaded are left out, as are the areas
+  without data for a chart when the step is sparse.
+  """
+  units = []
+  for s, step in enumerate(plan):
+    if shared["tables"][s] is None:
+      continue
+    for c, chart in enumerate(step["charts"]):
+      admin_areas = step["admin_areas"]
+      if step["sparse"]:
+        chart_areas = get_chart_areas(chart, shared["tables"][s])
+        admin_areas = [aa for aa in admin_areas if aa in chart_areas]
+      for aa in admin_areas:
+        for lang in step["langs"]:
+          units.append((s, c, aa, lang))
+  return units
+
+
+def write_indexes(plan, units):
+  """ Write an index for every chart of the sparse steps, listing the areas
+  a file was written for.
+  """
+  areas = {}
+  for s, c, aa, lang in units:
+    areas.setdefault((s, c, lang), []).append(aa.lower())
+
+  for s, step in enumerate(plan):
+    if not step["sparse"] or shared["tables"][s] is None:
+      continue
+    for c, chart in enumerate(step["charts"]):
+      for lang in step["langs"]:
+        file_path = step["index"].format(lang=lang,edition=step["edition"],indicator=chart["export"])
+        write_json(file_path, {"indicator": chart["export"], "areas": sorted(areas.get((s, c, lang), []))}, shared["staging"])
+
+
+@traced
+def render_unit(unit):
+  """ Render and write the document for a single unit. The data is fetched
+  from the shared tables, so this can run in a worker process.
+  """
+  s, c, aa, lang = unit
+  step = shared["plan"][s]
+  chart = step["charts"][c]
+
+  averages = False
+  if shared["avgs"][s]:
+    averages = chart_averages(chart, shared["avgs"][s], shared["aa_regions"])
+
+  json_data = build_chart(chart, shared["tables"][s], aa, lang, averages)
+
+  # Write the list to a JSON file
+  file_path = step["export"].format(lang=lang,edition=step["edition"],indicator=chart["export"],aa=aa.lower())
+  write_json(file_path, json_data, shared["staging"])
+
+  # The document is only sent back to the main process if it is bundled
+  if step["bundle"]:
+    return unit, json_data
+  return unit, None
+
+
+@traced
+def timed_render_unit(unit):
+  """ Render a unit, see render_unit. Returns the rendered unit and the time
+  it took.
+  """
+  start = time.time()
+  rendered = render_unit(unit)
+  return rendered, time.time() - start
+
+
+def unit_name(unit):
+  """ Returns a readable name of a unit for the progress (eg. 2017/aa/CL/en)
+  """
+  s, c, aa, lang = unit
+  step = shared["plan"][s]
+  return "%s/%s/%s/%s" % (step["edition"], step["charts"][c]["export"], aa, lang)
+
+
+def write_bundles(plan, rendered):
+  """ Write the bundled documents of the steps that request them. Every
+  bundle is keyed by iso and built from the documents that were rendered for
+  the individual files.
+  """
+  bundles = {}
+  for unit, json_data in rendered:
+    if json_data is None:
+      continue
+    s, c, aa, lang = unit
+    step = plan[s]
+    if step["bundle"] == 'region':
+      # Areas without a region end up in a separate bundle
+      shard = shared["aa_regions"].get(aa) or 'other'
+    else:
+      shard = None
+    bundles.setdefault((s, c, lang, shard), {})[aa.lower()] = json_data
+
+  for (s, c, lang, shard), data in sorted(bundles.items()):
+    step = plan[s]
+    chart = step["charts"][c]
+    if shard is None:
+      indicator = chart["export"]
+    else:
+      indicator = chart["export"] + '/' + shard
+    file_path = step["bundle_export"].format(lang=lang,edition=step["edition"],indicator=indicator)
+    write_json(file_path, {"indicator": chart["export"], "region": shard, "data": data}, shared["staging"])
+
+  return len(bundles)
+
+
+def run_plan(plan, workers=1, staging=None):
+  """ Execute the plan: load -> aggregate -> render -> write for every source.
+  When more than one worker is requested, the units are rendered and written
+  on a pool of processes. The files are written to the staging area, when one
+  is provided. Returns a dict with throughput statistics.
+  """
+  start = time.time()
+  shared["staging"] = staging
+  load_plan(plan)
+  loaded = time.time()
+
+  units = get_units(plan)
+  write_indexes(plan, units)
+  progress = Progress('Auxiliary documents', len(units), settings.progress_log)
+  if workers > 1:
+    pool = multiprocessing.Pool(workers)
+    # Large chunks keep the overhead of passing units around low
+    chunksize = max(1, len(units) // (workers * 4))
+    results = pool.imap(timed_render_unit, units, chunksize)
+  else:
+    results = (timed_render_unit(unit) for unit in units)
+  rendered = []
+  for (unit, json_data), seconds in results:
+    progress.done(unit_name(unit), seconds)
+    rendered.append((unit, json_data))
+  if workers > 1:
+    pool.close()
+    pool.join()
+  done = time.time()
+  progress.finish()
+
+  bundles = write_bundles(plan, rendered)
+
+  return {
+    "workers": workers,
+    "sources": len([table for table in shared["tables"] if table is not None]),
+    "documents": len(rendered),
+    "bundles": bundles,
+    "load_time": loaded - start,
+    "render_time": done - loaded,
+    "docs_per_sec": len(rendered) / max(done - loaded, 1e-6)
+  }
+
+
+def print_stats(stats):
+  """ Print the throughput statistics of a run
+  """
+  print "Loaded %s sources in %.2fs" % (stats["sources"], stats["load_time"])
+  print "Rendered %s documents in %.2fs with %s worker(s): %.1f documents/s" % (stats["documents"], stats["render_time"], stats["workers"], stats["docs_per_sec"])
+  if stats["bundles"]:
+    print "Wrote %s bundles" % (stats["bundles"])
+
+
+@traced
+def main(plan_only=False, workers=1, all_editions=False, sparse=False, bundle=None):
 
   #############################################################################
   # 0.
   #
 
-  # Check if tmp folder exists, otherwise create it
-  check_create_folder(settings.tmp_dir)
-  
   # Build the list with countries and states
-  admin_areas = get_aa_list()
+  meta = load_meta(settings.src_meta_aa, settings.src_meta_index, settings.meta_snapshot)
+  admin_areas = meta.areas('country', 'state')
 
-  for chart in settings.charts:
-    ind_source = settings.src_auxiliary + str(settings.current_edition) + '-' + str(chart["id"]) + '.csv'
-      
-    global_avg = False
-    # Calculate the global average for this chart    
-    if "global_average" in chart and chart["global_average"]:
-      global_avg = get_avg(chart, ind_source)
-    
-    for aa in admin_areas:
-      iso = aa.lower()
-      for lang in settings.langs:
-        # Initialize the array that will be written to JSON
-        json_data = {"name": iso, "iso": iso, "meta": {"title": chart["title"][lang], "label-x": chart["labelx"][lang], "label-y": chart["labely"][lang]}, "data": []}
-
-        for serie in chart["series"]:
-          if serie["id"] == 'country':
-            # If we're dealing with a country, use the country name as label of serie
-            serie_name = aa
-          else:
-            serie_name = serie["name"][lang]
-
-          # Initialize the object for the serie    
-          serie_to_append = {"name": serie_name, "id": serie["id"], "values": []}
-
-          # Add a note to the serie
-          if chart["note"]:
-            serie_to_append["note"] = add_note(serie, ind_source, aa)
-
-          # Generate the actual data
-          serie_to_append["values"] = chart['function'](serie, ind_source, lang, aa, chart["years"],global_avg)
-
-          json_data["data"].append(serie_to_append)
-
-        # Write the list to a JSON file
-        file_path = (settings.exp_aux_json).format(lang=lang,indicator=chart["export"],aa=iso)
-        write_json(file_path, json_data)
-  
-  # Fully remove the temp directory
-  clean_dir(settings.tmp_dir, True)
+  # Compile the charts into a plan that loads every source only once
+  if all_editions:
+    plan = []
+    for edition in get_editions():
+      plan += plan_charts(settings.charts, edition, admin_areas, settings.langs, archive=True, sparse=sparse, bundle=bundle)
+  else:
+    plan = plan_charts(settings.charts, settings.current_edition, admin_areas, settings.langs, sparse=sparse, bundle=bundle)
+
+  if plan_only:
+    print_plan(plan)
+    return
+
+  # Every run gets its own scratch folder, so runs don't clobber each other.
+  # The output is staged in it and only moved into the export folder when
+  # the run is done. The folder is removed when the run ends, also when it
+  # fails.
+  with scratch_dir('cs-auxiliary-', settings.tmp_dir) as d:
+    staging = Staging(settings.export_dir, d)
+
+    stats = run_plan(plan, workers, staging)
+    print_stats(stats)
+
+    # Move the output into the export folder
+    staging.commit()
 
   print "All done. The auxiliary data has been prepared for use on global-climatescope.org."
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  parser = argparse.ArgumentParser(description='Build the auxiliary data of the Climatescope.')
+  parser.add_argument('--plan', action='store_true', help='Print the execution plan and exit without building.')
+  parser.add_argument('--workers', type=int, default=1, help='Number of processes to render the charts with.')
+  parser.add_argument('--all-editions', action='store_true', help='Build every edition with data in the source folder, using edition-scoped output paths.')
+  parser.add_argument('--sparse', action='store_true', help='Only write the areas that have data for a chart, plus an index of them.')
+  parser.add_argument('--bundle', choices=['chart', 'region'], help='Also write one file per chart and language with the data of all areas, optionally split by region.')
+  parser.add_argument('--profile', metavar='FILE', help='Write the time of the traced functions as collapsed stacks to this file. Same as setting CS_PROFILE.')
+  args = parser.parse_args()
+
+  if args.profile:
+    enable(args.profile)
+
+  main(plan_only=args.plan, workers=args.workers, all_editions=args.all_editions, sparse=args.sparse, bundle=args.bundle)
@@ -8,6 +8,7 @@ import cs_auxiliary
 src_dir = 'source/'
 export_dir = 'data/'
 tmp_dir = 'tmp/'
+cache_dir = 'cache/'
 
 # Source - filenames / dirs
 src_core = src_dir + 'cs-core/'
@@ -16,6 +17,14 @@ src_auxiliary = src_dir + 'cs-auxiliary/'
 src_meta_aa = src_dir + 'meta/admin_areas.csv'
 src_meta_index = src_dir + 'meta/index.csv'
 
+# Snapshot of the parsed metadata. Set to None to parse the CSV files on
+# every run.
+meta_snapshot = cache_dir + 'meta.pickle'
+
+# The summaries of the long loops (items/s, slowest items) are appended to
+# this log, as a JSON object per line.
+progress_log = cache_dir + 'progress.log'
+
 # Export filenames
 exp_core_csv = export_dir + 'cs-core.csv'
 exp_full_csv = export_dir + '{lang}/download/data/climatescope-full.csv'
@@ -30,6 +39,11 @@ exp_region = export_dir + '{lang}/api/regions/{region}.json'
 exp_params = export_dir + '{lang}/api/parameters/{p}.json'
 exp_stats = export_dir + '{lang}/api/stats.json'
 exp_aux_json = export_dir + '{lang}/api/auxiliary/{indicator}/{aa}.json'
+exp_aux_json_edition = export_dir + '{lang}/api/auxiliary/{edition}/{indicator}/{aa}.json'
+exp_aux_index = export_dir + '{lang}/api/auxiliary/{indicator}/index.json'
+exp_aux_index_edition = export_dir + '{lang}/api/auxiliary/{edition}/{indicator}/index.json'
+exp_aux_bundle = export_dir + '{lang}/api/auxiliary/bundles/{indicator}.json'
+exp_aux_bundle_edition = export_dir + '{lang}/api/auxiliary/{edition}/bundles/{indicator}.json'
 
 # Source structure
 core_data_sheets = ['score', 'param', 'ind']
@@ -361,7 +375,7 @@ charts = [
   {
     "id": 903,
     "function": cs_auxiliary.default_chart,
-    "global_average": True,
+    "global_average": True, # Set "regional_average" to add the average of the region as well
     "export": 'price-attractiveness-electricity',
     "title": {
       "en": 'Price attractiveness',
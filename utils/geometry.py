@@ -0,0 +1,193 @@
+# Climatescope map geometries
+#
+# Reading and simplifying the 10m Natural Earth geometries is the slowest part
+# of drawing a map. The geometries of a shapefile are simplified once per
+# tolerance and stored as pickled NumPy arrays, keyed by the hash of the
+# shapefile and the tolerance. Later renders load them from there.
+#
+# The tolerances are powers of two in degrees, at most the size of a pixel of
+# the map, so maps of about the same scale share their geometries.
+#
+# Hashing the 10m shapefiles means reading all of them, so the hashes are
+# stored with the size and modification time of the files. The files are only
+# read again when those changed. Within a process, every shapefile is hashed
+# at most once.
+
+import cPickle as pickle
+import hashlib
+import json
+import math
+import os
+import os.path
+
+import numpy as np
+from osgeo import ogr
+
+# The hashes calculated by this process, by path, size and modification time
+hashes = {}
+
+
+def shapefile_hash(shp, cache_dir=None):
+  """Returns a hash of the geometries (.shp) and attributes (.dbf) of a
+  shapefile. With a cache_dir, the hash is looked up by the path, size and
+  modification time of the files first, and stored there when it had to be
+  calculated.
+
+  :param shp:
+    Path of the shapefile
+  :type shp:
+    String
+  :param cache_dir:
+    The directory with the stored hashes
+  :type cache_dir:
+    String
+  """
+  files = (shp, os.path.splitext(shp)[0] + '.dbf')
+  stamp = [[os.path.getsize(fn), os.path.getmtime(fn)] for fn in files]
+  key = os.path.abspath(shp)
+  memo_key = (key, repr(stamp))
+  if memo_key in hashes:
+    return hashes[memo_key]
+
+  index = {}
+  index_fn = cache_dir + 'shapefiles.json' if cache_dir else None
+  if index_fn and os.path.exists(index_fn):
+    with open(index_fn) as ifile:
+      index = json.load(ifile)
+    if key in index and index[key]['stamp'] == stamp:
+      hashes[memo_key] = index[key]['hash']
+      return hashes[memo_key]
+
+  h = hashlib.sha1()
+  for fn in files:
+    with open(fn, 'rb') as ifile:
+      for chunk in iter(lambda: ifile.read(1 << 20), b''):
+        h.update(chunk)
+  hashes[memo_key] = h.hexdigest()
+
+  if index_fn:
+    index[key] = {'stamp': stamp, 'hash': h.hexdigest()}
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    tmp_fn = '%s.%s' % (index_fn, os.getpid())
+    with open(tmp_fn, 'w') as ofile:
+      json.dump(index, ofile, indent=2, sort_keys=True)
+    os.rename(tmp_fn, index_fn)
+  return h.hexdigest()
+
+
+def read_polygons(geometry):
+  """Returns the polygons of a (multi)polygon geometry as a list of
+  polygons. Every polygon is a list of rings, the first ring is the exterior,
+  the others are holes. Every ring is a list of (lon, lat) points.
+
+  :param geometry:
+    The OGR geometry
+  :type geometry:
+    ogr.Geometry
+  """
+  name = geometry.GetGeometryName()
+  if name == 'POLYGON':
+    return [[geometry.GetGeometryRef(i).GetPoints() for i in range(geometry.GetGeometryCount())]]
+  elif name == 'MULTIPOLYGON':
+    polygons = []
+    for i in range(geometry.GetGeometryCount()):
+      polygons += read_polygons(geometry.GetGeometryRef(i))
+    return polygons
+  return []
+
+
+def tolerance(bbox, width):
+  """Returns the simplification tolerance for a map: the largest power of two
+  (in degrees) that isn't larger than a pixel.
+
+  :param bbox:
+    The bbox of the map (lon1, lat1, lon2, lat2)
+  :type bbox:
+    Tuple
+  :param width:
+    The width of the map in px
+  :type width:
+    Integer
+  """
+  degrees_per_px = (bbox[2] - bbox[0]) / float(width)
+  return 2.0 ** math.floor(math.log(degrees_per_px, 2))
+
+
+def cache_path(cache_dir, shp_hash, tol):
+  return '%sgeometries-%s-%g.pickle' % (cache_dir, shp_hash, tol)
+
+
+def simplify_shapefile(shp, attribute, tol):
+  """Returns the features of a shapefile, simplified with a tolerance, as a
+  list of (iso, envelope, polygons). The rings of the polygons are arrays
+  with a (lon, lat) row per point.
+  """
+  ds = ogr.Open(shp)
+  lyr = ds.GetLayer(0)
+  lyr.ResetReading()
+  features = []
+  feature = lyr.GetNextFeature()
+  while feature is not None:
+    geometry = feature.GetGeometryRef()
+    if geometry is not None:
+      simple = geometry.SimplifyPreserveTopology(tol)
+      polygons = [[np.array(ring, dtype=float)[:,:2] for ring in polygon if len(ring)] for polygon in read_polygons(simple)]
+      polygons = [polygon for polygon in polygons if polygon]
+      if polygons:
+        features.append((feature.GetField(attribute), simple.GetEnvelope(), polygons))
+    feature = lyr.GetNextFeature()
+  return features
+
+
+def cache_geometries(shp, attribute, tol, cache_dir, shp_hash=None):
+  """Simplify the features of a shapefile with a tolerance and cache them,
+  unless they are cached already. Returns the path of the cache file.
+
+  :param shp:
+    Path of the shapefile
+  :type shp:
+    String
+  :param attribute:
+    The attribute with the iso code of the admin area
+  :type attribute:
+    String
+  :param tol:
+    The simplification tolerance in degrees
+  :type tol:
+    Float
+  :param cache_dir:
+    The directory with the cached geometries
+  :type cache_dir:
+    String
+  :param shp_hash:
+    The hash of the shapefile, if it's known already
+  :type shp_hash:
+    String
+  """
+  if shp_hash is None:
+    shp_hash = shapefile_hash(shp, cache_dir)
+  path = cache_path(cache_dir, shp_hash, tol)
+  if os.path.exists(path):
+    return path
+
+  features = simplify_shapefile(shp, attribute, tol)
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+  # Write to a temporary file first, so other processes never read half a
+  # cache file
+  tmp_path = '%s.%s' % (path, os.getpid())
+  with open(tmp_path, 'wb') as ofile:
+    pickle.dump(features, ofile, pickle.HIGHEST_PROTOCOL)
+  os.rename(tmp_path, path)
+  return path
+
+
+def load_geometries(shp, attribute, tol, cache_dir, shp_hash=None):
+  """Returns the simplified features of a shapefile, see simplify_shapefile.
+  They are simplified and cached first when they aren't cached yet. The
+  parameters are the same as for cache_geometries.
+  """
+  path = cache_geometries(shp, attribute, tol, cache_dir, shp_hash)
+  with open(path, 'rb') as ifile:
+    return pickle.load(ifile)
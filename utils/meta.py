@@ -0,0 +1,213 @@
+# Climatescope metadata
+#
+# Parses the admin areas and the index of the Climatescope once into indexed
+# structures that are shared by all the scripts. Optionally, the parsed
+# metadata is stored in a pickled snapshot that is reused as long as the
+# source files don't change.
+
+import collections
+import cPickle as pickle
+import hashlib
+import os
+import os.path
+import threading
+
+import pandas as pd
+
+from profiling import traced
+
+
+# Columns that contain codes. Whitespace is stripped from these.
+aa_code_cols = ['iso', 'type', 'grid', 'region', 'country']
+index_code_cols = ['type', 'grid']
+
+AdminArea = collections.namedtuple('AdminArea', ['iso', 'type', 'name', 'grid', 'region', 'country', 'capital', 'lat', 'lon'])
+Variable = collections.namedtuple('Variable', ['id', 'type', 'name', 'description', 'unit', 'parent', 'weight', 'grid'])
+
+# The metadata that was loaded in this process, keyed by source files
+loaded = {}
+lock = threading.Lock()
+
+
+def strip_codes(df, cols):
+  """Strip the whitespace from the columns with codes that contain strings
+  """
+  for col in cols:
+    if col in df.columns and df[col].dtype == object:
+      df[col] = df[col].str.strip()
+
+
+def none_if_null(value):
+  """Returns None for NaN and empty values, the value otherwise
+  """
+  if pd.isnull(value) or value == '':
+    return None
+  return value
+
+
+def lang_dict(row, prefix):
+  """Build a dict with the value for every language of a column (eg. name:en
+  and name:es become {'en': ..., 'es': ...})
+  """
+  return dict((col.split(':')[1], none_if_null(row[col])) for col in row.index if col.startswith(prefix + ':'))
+
+
+class Metadata(object):
+  """The admin areas and index of the Climatescope, parsed once.
+
+  :param src_aa:
+    Path to the admin_areas.csv
+  :type src_aa:
+    String
+  :param src_index:
+    Path to the index.csv
+  :type src_index:
+    String
+  """
+
+  def __init__(self, src_aa, src_index):
+    df_aa = pd.read_csv(src_aa)
+    strip_codes(df_aa, aa_code_cols)
+    df_index = pd.read_csv(src_index)
+    strip_codes(df_index, index_code_cols)
+
+    # The frames, indexed on iso and id
+    self.df_aa = df_aa.set_index('iso')
+    self.df_index = df_index.set_index('id')
+
+    # The records in order of the source files
+    self.admin_areas = collections.OrderedDict()
+    for i, row in df_aa.iterrows():
+      self.admin_areas[row['iso']] = AdminArea(
+        iso=row['iso'],
+        type=row['type'],
+        name=lang_dict(row, 'name'),
+        grid=none_if_null(row['grid']),
+        region=none_if_null(row['region']),
+        country=none_if_null(row['country']),
+        capital=lang_dict(row, 'capital'),
+        lat=none_if_null(row['lat']),
+        lon=none_if_null(row['lon']))
+
+    self.variables = collections.OrderedDict()
+    for i, row in df_index.iterrows():
+      self.variables[row['id']] = Variable(
+        id=row['id'],
+        type=row['type'],
+        name=lang_dict(row, 'name'),
+        description=lang_dict(row, 'description'),
+        unit=lang_dict(row, 'unit'),
+        parent=none_if_null(row['parent']),
+        weight=none_if_null(row['weight']),
+        grid=none_if_null(row['grid']))
+
+    # Lookups from a country to its states and from a variable to its children
+    self.country_states = collections.defaultdict(list)
+    for aa in self.admin_areas.values():
+      if aa.type == 'state' and aa.country:
+        self.country_states[aa.country].append(aa.iso)
+
+    self.variable_children = collections.defaultdict(list)
+    for var in self.variables.values():
+      if var.parent is not None:
+        self.variable_children[var.parent].append(var.id)
+
+  @traced
+  def areas(self, *types):
+    """Returns the iso codes of the admin areas of the given types (eg.
+    'country', 'state'), in the order of the source file
+    """
+    return [aa.iso for aa in self.admin_areas.values() if aa.type in types]
+
+  @traced
+  def states(self, country):
+    """Returns the iso codes of the states of a country
+    """
+    return list(self.country_states.get(country, []))
+
+  @traced
+  def region(self, iso):
+    """Returns the region of a country. States take the region of their
+    country.
+    """
+    aa = self.admin_areas.get(iso)
+    if aa is None:
+      return None
+    if aa.type == 'state':
+      return self.region(aa.country)
+    return aa.region
+
+  @traced
+  def ids(self, var_type):
+    """Returns the ids of the variables of a type (eg. 'param')
+    """
+    return [var.id for var in self.variables.values() if var.type == var_type]
+
+  @traced
+  def children(self, var_id):
+    """Returns the ids of the variables with var_id as parent
+    """
+    return list(self.variable_children.get(var_id, []))
+
+
+def file_hash(*paths):
+  """Returns a hash of the contents of one or more files
+  """
+  h = hashlib.sha1()
+  for path in paths:
+    with open(path, 'rb') as ifile:
+      h.update(ifile.read())
+  return h.hexdigest()
+
+
+@traced
+def load_meta(src_aa, src_index, snapshot=None):
+  """Returns the metadata for the source files. It is parsed only once per
+  process. If a path for a snapshot is provided, the parsed metadata is
+  pickled to it and later runs load it from there, as long as the source
+  files didn't change.
+
+  :param src_aa:
+    Path to the admin_areas.csv
+  :type src_aa:
+    String
+  :param src_index:
+    Path to the index.csv
+  :type src_index:
+    String
+  :param snapshot:
+    Path to the pickled snapshot
+  :type snapshot:
+    String
+
+  :returns:
+    (Metadata) the parsed metadata
+  """
+  key = (src_aa, src_index)
+  with lock:
+    if key in loaded:
+      return loaded[key]
+
+    meta = None
+    if snapshot:
+      source_hash = file_hash(src_aa, src_index)
+      if os.path.exists(snapshot):
+        try:
+          with open(snapshot, 'rb') as ifile:
+            snapshot_hash, meta = pickle.load(ifile)
+          if snapshot_hash != source_hash:
+            meta = None
+        except Exception:
+          # A snapshot from another version of the code, parse again
+          meta = None
+
+    if meta is None:
+      meta = Metadata(src_aa, src_index)
+      if snapshot:
+        if os.path.dirname(snapshot) and not os.path.exists(os.path.dirname(snapshot)):
+          os.makedirs(os.path.dirname(snapshot))
+        with open(snapshot, 'wb') as ofile:
+          pickle.dump((source_hash, meta), ofile, pickle.HIGHEST_PROTOCOL)
+
+    loaded[key] = meta
+    return meta
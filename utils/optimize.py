@@ -0,0 +1,187 @@
+# Climatescope PNG optimization
+#
+# Recompresses the exported maps on a pool of workers. Images with 256 colors
+# or less are stored as a palette image, which is lossless. Others are only
+# recompressed, unless quantizing is requested, which reduces them to a
+# palette of 256 colors.
+#
+# The hash of every optimized image is recorded, so images that didn't change
+# since they were optimized are skipped. Images that were optimized without
+# quantizing are optimized again when quantizing is requested.
+
+import hashlib
+import json
+import os
+import os.path
+from multiprocessing import Pool
+
+import numpy as np
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+
+def file_hash(path):
+  """Returns the hash of the contents of a file
+  """
+  with open(path, 'rb') as ifile:
+    return hashlib.sha1(ifile.read()).hexdigest()
+
+
+def to_palette(image):
+  """Returns the image as a palette image with exactly the same colors, or
+  None if it has more than 256 colors.
+  """
+  rgb = np.asarray(image.convert('RGB'), dtype=np.uint32)
+  packed = (rgb[:,:,0] << 16) | (rgb[:,:,1] << 8) | rgb[:,:,2]
+  colors, indexes = np.unique(packed, return_inverse=True)
+  if len(colors) > 256:
+    return None
+
+  palette = np.zeros((len(colors), 3), dtype=np.uint8)
+  palette[:,0] = colors >> 16
+  palette[:,1] = (colors >> 8) & 255
+  palette[:,2] = colors & 255
+  result = Image.fromarray(indexes.reshape(packed.shape).astype(np.uint8), 'P')
+  result.putpalette(palette.ravel().tolist())
+  return result
+
+
+def optimize_png(path, quantize=False):
+  """Optimize a PNG in place. The file is only replaced when the optimized
+  image is smaller. Returns the size before and after.
+
+  :param path:
+    Path of the PNG
+  :type path:
+    String
+  :param quantize:
+    Reduce images with more than 256 colors to a palette (lossy)
+  :type quantize:
+    Boolean
+  """
+  before = os.path.getsize(path)
+  image = Image.open(path)
+  image.load()
+  # An alpha channel that is opaque everywhere can go
+  if image.mode == 'RGBA' and image.getextrema()[3] == (255, 255):
+    image = image.convert('RGB')
+  if image.mode not in ('RGB', 'RGBA', 'P', 'L'):
+    image = image.convert('RGB')
+
+  optimized = image
+  if image.mode in ('RGB', 'P'):
+    optimized = to_palette(image)
+    if optimized is None:
+      optimized = image.convert('RGB').quantize(256) if quantize else image
+
+  # The temporary file is unique per process, so runs that optimize the same
+  # image don't write to the same file
+  tmp_path = '%s.%s.tmp' % (path, os.getpid())
+  optimized.save(tmp_path, 'PNG', optimize=True)
+  after = os.path.getsize(tmp_path)
+  if after < before:
+    os.rename(tmp_path, path)
+  else:
+    os.remove(tmp_path)
+    after = before
+  return before, after
+
+
+def optimize_file(args):
+  """Optimize one image for the worker pool. Returns (path, before, after,
+  hash) or (path, None, None, error) when it failed.
+  """
+  path, quantize = args
+  try:
+    before, after = optimize_png(path, quantize)
+  except Exception as e:
+    return path, None, None, str(e)
+  return path, before, after, file_hash(path)
+
+
+def optimize_images(paths, record_fn, base_dir, workers=1, quantize=False):
+  """Optimize the images that weren't optimized yet on a pool of workers. The
+  hashes of the optimized images are stored in record_fn, by path relative
+  to base_dir. Returns a list of (path, before, after) for the optimized
+  images.
+
+  :param paths:
+    Paths of the PNGs
+  :type paths:
+    List
+  :param record_fn:
+    Path of the JSON file with the hashes of the optimized images
+  :type record_fn:
+    String
+  :param base_dir:
+    Directory the paths in the record are relative to
+  :type base_dir:
+    String
+  :param workers:
+    Amount of images to optimize at the same time
+  :type workers:
+    Integer
+  :param quantize:
+    Reduce images with more than 256 colors to a palette (lossy)
+  :type quantize:
+    Boolean
+  """
+  if Image is None:
+    raise ImportError('Optimizing the maps requires PIL.')
+
+  record = {}
+  if os.path.exists(record_fn):
+    with open(record_fn) as ifile:
+      record = json.load(ifile)
+
+  todo = []
+  for path in paths:
+    if not os.path.exists(path):
+      continue
+    done = record.get(os.path.relpath(path, base_dir))
+    if done is None or done['hash'] != file_hash(path) or (quantize and not done['quantize']):
+      todo.append(path)
+  print "%s of %s maps are optimized already." % (len(paths) - len(todo), len(paths))
+
+  pool = Pool(workers)
+  try:
+    results = pool.map(optimize_file, [(path, quantize) for path in todo], 1)
+  finally:
+    pool.close()
+    pool.join()
+
+  optimized = []
+  for path, before, after, h in results:
+    key = os.path.relpath(path, base_dir)
+    if before is None:
+      print 'Optimizing %s failed: %s' % (path, h)
+      record.pop(key, None)
+      continue
+    record[key] = {'hash': h, 'quantize': quantize}
+    optimized.append((path, before, after))
+
+  tmp_fn = '%s.%s' % (record_fn, os.getpid())
+  with open(tmp_fn, 'w') as ofile:
+    json.dump(record, ofile, indent=2, sort_keys=True)
+  os.rename(tmp_fn, record_fn)
+
+  return optimized
+
+
+def print_savings(optimized, base_dir):
+  """Print the bytes saved per directory (eg. per language)
+  """
+  dirs = {}
+  for path, before, after in optimized:
+    d = os.path.dirname(os.path.relpath(path, base_dir)) or '.'
+    totals = dirs.setdefault(d, [0, 0, 0])
+    totals[0] += 1
+    totals[1] += before
+    totals[2] += after
+
+  for d in sorted(dirs):
+    count, before, after = dirs[d]
+    print '%s: %s maps, %s bytes saved (%s -> %s, %.1f%%)' % (d, count, before - after, before, after, 100.0 * (before - after) / max(before, 1))
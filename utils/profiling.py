@@ -0,0 +1,175 @@
+# Climatescope profiling
+#
+# Opt-in tracing of the entry points of the build. Functions decorated with
+# @traced record their time when profiling is enabled, with the stack of
+# traced functions they were called from. The result is written as collapsed
+# stacks, one "stage;main;build_json_aa;get_rank <microseconds>" line per
+# stack, ready for flamegraph.pl, speedscope and the like. The time of a line
+# is the self time: the time spent in the function, minus the time spent in
+# the traced functions it called.
+#
+# The first frame of every stack is the stage, so the time of a build with
+# several stages can be told apart. It defaults to the name of the script.
+#
+# Profiling is enabled with the CS_PROFILE environment variable, set to the
+# output file, or with the --profile flag of the scripts:
+#
+#   CS_PROFILE=core.folded python cs-core.py
+#   python cs-pipeline.py --profile build.folded
+#   flamegraph.pl build.folded > build.svg
+#
+# Only the process that enabled profiling writes its stacks. The stages of the
+# pipeline send their stacks back to it, see merge. Functions that run on
+# worker processes (eg. cs_auxiliary.py --workers 4) are not included, profile
+# with a single worker to see them.
+
+import atexit
+import functools
+import os
+import os.path
+import sys
+import threading
+import timeit
+
+state = {
+  'enabled': False,
+  'output': None,
+  'stage': None
+}
+# Self time per collapsed stack, in seconds
+stacks = {}
+lock = threading.Lock()
+local = threading.local()
+
+
+def enable(output, stage=None):
+  """Enable profiling. The stacks are written to output when the process
+  exits.
+
+  :param output:
+    Path of the collapsed stacks file
+  :type output:
+    String
+  :param stage:
+    Name of the default stage. Defaults to the name of the script.
+  :type stage:
+    String
+  """
+  if not state['enabled']:
+    atexit.register(write)
+  state['enabled'] = True
+  state['output'] = output
+  state['stage'] = stage or os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'
+
+
+def frames():
+  """Returns the stack of traced functions of the current thread
+  """
+  if not hasattr(local, 'frames'):
+    local.frames = []
+  return local.frames
+
+
+class stage(object):
+  """Context manager that sets the stage of the stacks recorded in the
+  current thread (eg. the stages of the pipeline)
+  """
+
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    self.previous = getattr(local, 'stage', None)
+    local.stage = self.name
+
+  def __exit__(self, *exc):
+    local.stage = self.previous
+
+
+def traced(fn):
+  """Decorator that records the time of a function when profiling is
+  enabled. When it's not, the function is called as is.
+  """
+  name = fn.__name__
+
+  @functools.wraps(fn)
+  def wrapper(*args, **kwargs):
+    if not state['enabled']:
+      return fn(*args, **kwargs)
+
+    stack = frames()
+    # Every frame keeps track of the time spent in the traced functions it
+    # calls, to calculate its self time
+    frame = [name, 0.0]
+    stack.append(frame)
+    start = timeit.default_timer()
+    try:
+      return fn(*args, **kwargs)
+    finally:
+      elapsed = timeit.default_timer() - start
+      stack.pop()
+      path = ';'.join([getattr(local, 'stage', None) or state['stage']] + [f[0] for f in stack] + [name])
+      with lock:
+        stacks[path] = stacks.get(path, 0.0) + elapsed - frame[1]
+      if stack:
+        stack[-1][1] += elapsed
+
+  return wrapper
+
+
+def collected():
+  """Returns a copy of the stacks recorded so far, eg. to send them to the
+  process that writes them
+  """
+  with lock:
+    return dict(stacks)
+
+
+def reset():
+  """Forget the stacks recorded so far, eg. the ones a forked process
+  inherited from its parent
+  """
+  with lock:
+    stacks.clear()
+
+
+def merge(other):
+  """Add the stacks recorded by another process to the ones of this process
+
+  :param other:
+    The self time per collapsed stack, see collected
+  :type other:
+    Dict
+  """
+  with lock:
+    for path, seconds in other.items():
+      stacks[path] = stacks.get(path, 0.0) + seconds
+
+
+def write():
+  """Write the collapsed stacks to the output file and print the total time
+  per stage
+  """
+  with lock:
+    items = sorted(stacks.items())
+  if not items:
+    return
+
+  if os.path.dirname(state['output']) and not os.path.exists(os.path.dirname(state['output'])):
+    os.makedirs(os.path.dirname(state['output']))
+  with open(state['output'], 'w') as ofile:
+    for path, seconds in items:
+      ofile.write('%s %d\n' % (path, int(round(seconds * 1e6))))
+
+  totals = {}
+  for path, seconds in items:
+    name = path.split(';')[0]
+    totals[name] = totals.get(name, 0.0) + seconds
+  print "Wrote %s profiled stacks to %s" % (len(items), state['output'])
+  for name in sorted(totals):
+    print "  %s: %.2fs traced" % (name, totals[name])
+
+
+# Profiling can be enabled for any script from the environment
+if os.environ.get('CS_PROFILE'):
+  enable(os.environ['CS_PROFILE'])
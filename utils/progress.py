@@ -0,0 +1,134 @@
+# Climatescope progress
+#
+# Reports the progress of long loops (eg. over all the admin areas): the
+# number of items done, items per second and the estimated time left, every
+# few seconds. When the loop is done, a summary with the slowest items is
+# printed and appended as a JSON line to a log, so slow areas can be spotted
+# across runs.
+
+import heapq
+import json
+import os
+import os.path
+import threading
+import time
+
+
+class Progress(object):
+  """Progress of a loop over a known number of items. Items can be reported
+  from several threads.
+
+  :param name:
+    Name of the loop, used in the output
+  :type name:
+    String
+  :param total:
+    The number of items
+  :type total:
+    Integer
+  :param log:
+    Path of the JSON lines file to append the summary to
+  :type log:
+    String
+  :param interval:
+    Seconds between the progress lines
+  :type interval:
+    Float
+  :param slowest:
+    The number of slowest items to keep
+  :type slowest:
+    Integer
+  """
+
+  def __init__(self, name, total, log=None, interval=5.0, slowest=5):
+    self.name = name
+    self.total = total
+    self.log = log
+    self.interval = interval
+    self.slowest_count = slowest
+    self.count = 0
+    self.slowest = []
+    self.start = time.time()
+    self.reported = self.start
+    self.lock = threading.Lock()
+
+  def done(self, key, seconds):
+    """Report an item as done
+
+    :param key:
+      Name of the item (eg. the iso code of the area)
+    :type key:
+      String
+    :param seconds:
+      The time the item took
+    :type seconds:
+      Float
+    """
+    with self.lock:
+      self.count += 1
+      # Keep the slowest items in a small heap, the fastest of them on top
+      if len(self.slowest) < self.slowest_count:
+        heapq.heappush(self.slowest, (seconds, key))
+      elif seconds > self.slowest[0][0]:
+        heapq.heapreplace(self.slowest, (seconds, key))
+
+      now = time.time()
+      if now - self.reported >= self.interval and self.count < self.total:
+        self.reported = now
+        print self.status(now)
+
+  def item(self, key):
+    """Returns a context manager that times an item and reports it as done
+    """
+    return Item(self, key)
+
+  def rate(self, now):
+    return self.count / max(now - self.start, 1e-6)
+
+  def status(self, now):
+    """Returns a line with the progress so far
+    """
+    rate = self.rate(now)
+    eta = (self.total - self.count) / rate if rate else 0
+    return "%s: %s/%s (%.0f%%), %.1f items/s, ETA %.0fs" % (self.name, self.count, self.total, 100.0 * self.count / max(self.total, 1), rate, eta)
+
+  def finish(self):
+    """Print the summary with the slowest items and append it to the log.
+    Returns the summary.
+    """
+    now = time.time()
+    summary = {
+      "name": self.name,
+      "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start)),
+      "items": self.count,
+      "seconds": round(now - self.start, 3),
+      "items_per_sec": round(self.rate(now), 2),
+      "slowest": [{"item": key, "seconds": round(seconds, 4)} for seconds, key in sorted(self.slowest, reverse=True)]
+    }
+
+    print "%s: %s items in %.1fs, %.1f items/s" % (self.name, summary["items"], summary["seconds"], summary["items_per_sec"])
+    if summary["slowest"]:
+      print "  slowest: %s" % ', '.join(["%s (%.2fs)" % (s["item"], s["seconds"]) for s in summary["slowest"]])
+
+    if self.log:
+      if os.path.dirname(self.log) and not os.path.exists(os.path.dirname(self.log)):
+        os.makedirs(os.path.dirname(self.log))
+      with open(self.log, 'a') as ofile:
+        ofile.write(json.dumps(summary) + '\n')
+
+    return summary
+
+
+class Item(object):
+  """Times an item of a Progress, see Progress.item
+  """
+
+  def __init__(self, progress, key):
+    self.progress = progress
+    self.key = key
+
+  def __enter__(self):
+    self.start = time.time()
+
+  def __exit__(self, *exc):
+    self.progress.done(self.key, time.time() - self.start)
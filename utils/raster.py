@@ -0,0 +1,247 @@
+# Climatescope raster maps
+#
+# Draws the static maps straight from the geometries of the shapefiles into a
+# PNG, without Tilemill. The geometries are simplified for the scale of the map
+# and cached, see geometry.py. The maps are drawn in web mercator, like the Tilemill export:
+# the areas around the active one in grey, the active area highlighted with a
+# white outline and a marker with the name of its capital.
+#
+# Requires PIL (or Pillow). Without it, only the Tilemill renderer can be
+# used.
+
+import math
+
+import numpy as np
+
+from geometry import load_geometries, shapefile_hash, tolerance
+from render import Exporter, scaled
+
+try:
+  from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+  Image = None
+
+# The colors of the Tilemill stylesheet
+background_color = '#f2f2f2'
+area_color = '#dddddd'
+active_color = '#C3D500'
+outline_color = '#ffffff'
+text_color = '#333333'
+
+# Sizes in px
+outline_width = 2
+marker_size = 12
+marker_outline_width = 2
+text_size = 32
+text_dy = -16
+text_halo = 1
+font_names = ('Ubuntu-R.ttf', 'Ubuntu-Regular.ttf', 'DejaVuSans.ttf')
+
+# Web mercator isn't defined beyond these latitudes
+max_lat = 85.0511287798
+
+
+def mercator_y(lat):
+  """Returns the web mercator y of a latitude, in radians
+  """
+  lat = max(-max_lat, min(max_lat, lat))
+  return math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+
+def mercator_lat(y):
+  """Returns the latitude of a web mercator y
+  """
+  return math.degrees(2 * math.atan(math.exp(y)) - math.pi / 2)
+
+
+class Projection(object):
+  """Projects longitudes and latitudes onto the pixels of an image of width x
+  height. The bbox is centered and fitted in the image with the same scale
+  for both axes, so the areas keep their shape.
+
+  :param bbox:
+    The bbox (lon1, lat1, lon2, lat2)
+  :type bbox:
+    Tuple
+  """
+
+  def __init__(self, bbox, width, height):
+    lon1, lat1, lon2, lat2 = bbox
+    x1, x2 = math.radians(lon1), math.radians(lon2)
+    y1, y2 = mercator_y(lat1), mercator_y(lat2)
+    self.width = width
+    self.height = height
+    self.center_x = (x1 + x2) / 2
+    self.center_y = (y1 + y2) / 2
+    self.scale = min(width / (x2 - x1), height / (y2 - y1))
+
+  def point(self, lon, lat):
+    return (self.width / 2.0 + (math.radians(lon) - self.center_x) * self.scale,
+            self.height / 2.0 - (mercator_y(lat) - self.center_y) * self.scale)
+
+  def ring(self, points):
+    """Projects an array with a (lon, lat) row per point, returns a list of
+    (x, y) pixels
+    """
+    points = np.asarray(points, dtype=float)
+    lat = np.clip(points[:,1], -max_lat, max_lat)
+    x = self.width / 2.0 + (np.radians(points[:,0]) - self.center_x) * self.scale
+    y = self.height / 2.0 - (np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) - self.center_y) * self.scale
+    return zip(x.tolist(), y.tolist())
+
+  def bounds(self):
+    """Returns the (lon1, lat1, lon2, lat2) that is visible in the image
+    """
+    dx = self.width / 2.0 / self.scale
+    dy = self.height / 2.0 / self.scale
+    return (math.degrees(self.center_x - dx), mercator_lat(self.center_y - dy),
+            math.degrees(self.center_x + dx), mercator_lat(self.center_y + dy))
+
+
+def load_font(size):
+  """Returns the first font of font_names that is installed, or the default
+  font of PIL
+  """
+  for name in font_names:
+    try:
+      return ImageFont.truetype(name, size)
+    except IOError:
+      pass
+  return ImageFont.load_default()
+
+
+def draw_polygons(image, polygons, projection, color, scale=1):
+  """Fill the polygons and draw their outlines. Polygons with holes are
+  filled through a mask, so the holes stay empty.
+  """
+  draw = ImageDraw.Draw(image)
+  for polygon in polygons:
+    rings = [projection.ring(ring) for ring in polygon]
+    if len(rings) == 1:
+      draw.polygon(rings[0], fill=color)
+    else:
+      mask = Image.new('L', image.size, 0)
+      mask_draw = ImageDraw.Draw(mask)
+      mask_draw.polygon(rings[0], fill=255)
+      for hole in rings[1:]:
+        mask_draw.polygon(hole, fill=0)
+      image.paste(color, (0, 0), mask)
+    for ring in rings:
+      draw.line(ring, fill=outline_color, width=int(round(outline_width * scale)))
+
+
+def draw_capital(image, point, name, font, scale=1):
+  """Draw the marker of a capital with its name above it
+  """
+  draw = ImageDraw.Draw(image)
+  x, y = point
+  r = marker_size * scale / 2.0
+  draw.ellipse((x - r, y - r, x + r, y + r), fill=text_color)
+  r -= marker_outline_width * scale
+  draw.ellipse((x - r, y - r, x + r, y + r), fill=outline_color)
+
+  if name:
+    # The names in the metadata are UTF-8 encoded, PIL needs them as unicode
+    # to draw every character as one glyph
+    if isinstance(name, str):
+      name = name.decode('utf-8')
+    w, h = draw.textsize(name, font=font)
+    tx = x - w / 2.0
+    ty = y + text_dy * scale - h
+    halo = int(round(text_halo * scale))
+    for dx in range(-halo, halo + 1):
+      for dy in range(-halo, halo + 1):
+        if dx or dy:
+          draw.text((tx + dx, ty + dy), name, font=font, fill=outline_color)
+    draw.text((tx, ty), name, font=font, fill=text_color)
+
+
+class RasterExporter(Exporter):
+  """Export the maps with PIL, from the simplified geometries of the
+  shapefiles. Every slot loads the geometries it needs once.
+
+  :param layers:
+    The shapefile and its attribute with the iso code, by aa_type
+    (eg. {'c': ('countries.shp', 'ISO_A2')})
+  :type layers:
+    Dict
+  :param capitals:
+    The capital of every admin area as (lon, lat, {lang: name})
+  :type capitals:
+    Dict
+  :param cache_dir:
+    The directory with the cached geometries
+  :type cache_dir:
+    String
+  :param hashes:
+    The hash of the shapefile of every layer, by aa_type. Hashed when not
+    given.
+  :type hashes:
+    Dict
+  """
+
+  def __init__(self, layers, capitals, cache_dir, hashes=None):
+    if Image is None:
+      raise ImportError('The raster renderer requires PIL. Install Pillow or use the Tilemill renderer.')
+    self.layers = layers
+    self.capitals = capitals
+    self.cache_dir = cache_dir
+    if hashes is None:
+      hashes = dict((aa_type, shapefile_hash(shp, cache_dir)) for aa_type, (shp, attribute) in layers.items())
+    self.hashes = hashes
+
+  def prepare(self, slot, scratch_dir):
+    return {'geometries': {}, 'fonts': {}}
+
+  def geometries(self, slot, aa_type, tol):
+    """Returns the simplified features of a layer
+    """
+    key = (aa_type, tol)
+    if key not in slot['geometries']:
+      shp, attribute = self.layers[aa_type]
+      slot['geometries'][key] = load_geometries(shp, attribute, tol, self.cache_dir, self.hashes[aa_type])
+    return slot['geometries'][key]
+
+  def features(self, slot, aa_type, tol, bbox):
+    """Returns the (iso, polygons) of the simplified features of a layer in a
+    bbox
+    """
+    lon1, lat1, lon2, lat2 = bbox
+    features = []
+    for iso, env, polygons in self.geometries(slot, aa_type, tol):
+      if env[1] >= lon1 and env[0] <= lon2 and env[3] >= lat1 and env[2] <= lat2:
+        features.append((iso, polygons))
+    return features
+
+  def font(self, slot, size):
+    if size not in slot['fonts']:
+      slot['fonts'][size] = load_font(size)
+    return slot['fonts'][size]
+
+  def export(self, job, slot):
+    # The scale is the pixel density: the extent of the map stays the same,
+    # the sizes of the image, lines, marker and text grow with it
+    scale = job.get('scale', 1)
+    width = scaled(job['width'], scale)
+    height = scaled(job['height'], scale)
+    projection = Projection(job['bbox_coords'], width, height)
+
+    image = Image.new('RGB', (width, height), background_color)
+    active = []
+    tol = job.get('tolerance') or tolerance(job['bbox_coords'], width)
+    for iso, polygons in self.features(slot, job['aa_type'], tol, projection.bounds()):
+      if iso == job['iso']:
+        active += polygons
+      else:
+        draw_polygons(image, polygons, projection, area_color, scale)
+    # The active area goes on top, so its outline isn't covered
+    draw_polygons(image, active, projection, active_color, scale)
+
+    capital = self.capitals.get(job['iso'])
+    if capital is not None:
+      lon, lat, names = capital
+      name = names.get(job['lang']) or names.get('en')
+      draw_capital(image, projection.point(lon, lat), name, self.font(slot, int(round(text_size * scale))), scale)
+
+    image.save(job['output'], 'PNG')
+    return 0
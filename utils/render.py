@@ -0,0 +1,227 @@
+# Climatescope map rendering
+#
+# Runs render jobs for the static maps on a number of workers. The actual
+# rendering is done by an exporter. Every worker gets its own slot from the
+# exporter, so jobs that run at the same time don't share any files.
+#
+# A render job is a dict with the following keys:
+#   iso, lang, aa_type, bbox, bbox_coords, cartocss, output, width, height
+# and optionally scale and variants. The scale is the pixel density of the
+# export: the map has the same extent and layout as at scale 1, with width *
+# scale x height * scale pixels. The variants are a list of (scale, output)
+# with the largest scale (the one of the job and its output) first. After the
+# export, the other variants are resized from output.
+
+import abc
+import os
+import os.path
+import Queue
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+
+class Exporter(object):
+  """Interface for the exporters that render the jobs. Alternative exporters
+  (eg. FakeExporter for testing) have to implement export, and can implement
+  prepare.
+  """
+  __metaclass__ = abc.ABCMeta
+
+  def prepare(self, slot, scratch_dir):
+    """Prepare a slot for a worker. Returns an object that is passed to every
+    export in this slot.
+
+    :param slot:
+      Number of the slot
+    :type slot:
+      Integer
+    :param scratch_dir:
+      Directory the slot can use for its own files
+    :type scratch_dir:
+      String
+    """
+    return slot
+
+  @abc.abstractmethod
+  def export(self, job, slot):
+    """Render a job. Returns the exit code, 0 on success.
+    """
+
+
+class FakeExporter(Exporter):
+  """Exporter that doesn't render anything, for testing the scheduling of the
+  jobs without Tilemill. It keeps the (slot, job) of every export in memory,
+  in the order they were exported. Nothing is written, so the jobs should
+  only have one variant.
+
+  :param codes:
+    The exit code to return for some of the jobs, by iso. Other jobs
+    succeed.
+  :type codes:
+    Dict
+  """
+
+  def __init__(self, codes=None):
+    self.codes = codes or {}
+    self.exported = []
+
+  def export(self, job, slot):
+    self.exported.append((slot, job))
+    return self.codes.get(job['iso'], 0)
+
+
+class TilemillExporter(Exporter):
+  """Export the maps with Tilemill. Every slot gets its own copy of the
+  project with its own stylesheet. The files of the original project are
+  symlinked into the copy, only style.mss is written per job.
+
+  :param tm_dir:
+    The Tilemill installation directory
+  :type tm_dir:
+    String
+  :param project:
+    The name of the Tilemill project
+  :type project:
+    String
+  :param files_dir:
+    The Tilemill files directory that contains the project
+  :type files_dir:
+    String
+  """
+
+  def __init__(self, tm_dir, project, files_dir='tilemill'):
+    self.tm_dir = tm_dir
+    self.project = project
+    self.files_dir = files_dir
+
+  def prepare(self, slot, scratch_dir):
+    src = os.path.join(self.files_dir, 'project', self.project)
+    slot_dir = os.path.join(scratch_dir, 'slot-%s' % slot)
+    dst = os.path.join(slot_dir, 'project', self.project)
+    os.makedirs(dst)
+    for fn in os.listdir(src):
+      if fn != 'style.mss':
+        os.symlink(os.path.abspath(os.path.join(src, fn)), os.path.join(dst, fn))
+    return slot_dir
+
+  def export(self, job, slot_dir):
+    mss = os.path.join(slot_dir, 'project', self.project, 'style.mss')
+    with open(mss, 'w') as ofile:
+      ofile.write(job['cartocss'])
+
+    # Build the export command
+    scale = job.get('scale', 1)
+    command = "node %sindex.js export %s %s --format=png --width=%s --height=%s --bbox=%s --files='%s'" % (self.tm_dir, self.project, job['output'], scaled(job['width'], scale), scaled(job['height'], scale), job['bbox'], slot_dir)
+    if scale != 1:
+      # Draw the lines, markers and labels at the same density as the pixels
+      command += " --scale=%s" % scale
+    # shlex makes sure that all arguments are correctly passed, most notably the bounding box
+    args = shlex.split(command)
+    return subprocess.call(args)
+
+
+def scaled(size, scale):
+  """Returns a size in px at a pixel density
+  """
+  return int(round(size * scale))
+
+
+def write_variants(job):
+  """Resize the exported image of a job to its other variants
+  """
+  variants = job.get('variants') or []
+  if len(variants) < 2:
+    return
+  if Image is None:
+    raise ImportError('Exporting maps at several scales requires PIL.')
+
+  image = Image.open(job['output'])
+  image.load()
+  top_scale = variants[0][0]
+  for scale, output in variants[1:]:
+    size = (int(round(image.size[0] * scale / top_scale)), int(round(image.size[1] * scale / top_scale)))
+    image.resize(size, Image.ANTIALIAS).save(output, 'PNG')
+
+
+def export_job(exporter, job, slot):
+  """Export a job and write its variants. Returns the exit code.
+  """
+  code = exporter.export(job, slot)
+  if code == 0:
+    write_variants(job)
+  return code
+
+
+def render_jobs(jobs, exporter, workers=1, progress=None):
+  """Render a list of jobs with an exporter on a number of workers. Returns a
+  list with a result for every job, in the same order as the jobs. A result
+  is a dict with the job, its exit code and the time it took.
+
+  :param jobs:
+    The render jobs
+  :type jobs:
+    List
+  :param exporter:
+    The exporter to render the jobs with
+  :type exporter:
+    Exporter
+  :param workers:
+    Amount of jobs to run at the same time
+  :type workers:
+    Integer
+  :param progress:
+    Progress to report every job to
+  :type progress:
+    Progress
+  """
+  scratch_dir = tempfile.mkdtemp(prefix='cs-static-maps-')
+  slots = Queue.Queue()
+  for slot in range(workers):
+    slots.put(exporter.prepare(slot, scratch_dir))
+
+  def run(job):
+    slot = slots.get()
+    start = time.time()
+    try:
+      code = export_job(exporter, job, slot)
+    except Exception as e:
+      print 'Rendering %s (%s) failed: %s' % (job['iso'], job['lang'], e)
+      code = -1
+    finally:
+      slots.put(slot)
+    result = {'job': job, 'code': code, 'seconds': time.time() - start}
+    if progress is not None:
+      progress.done('%s (%s)' % (job['iso'], job['lang']), result['seconds'])
+    return result
+
+  pool = ThreadPool(workers)
+  try:
+    results = pool.map(run, jobs, 1)
+  finally:
+    pool.close()
+    pool.join()
+    shutil.rmtree(scratch_dir)
+
+  return results
+
+
+def print_summary(results, elapsed):
+  """Print the exit codes and timings of the rendered jobs
+  """
+  failed = [r for r in results if r['code'] != 0]
+  seconds = [r['seconds'] for r in results]
+
+  print 'Rendered %s maps in %.1fs (%.2f maps/s).' % (len(results), elapsed, len(results) / max(elapsed, 1e-6))
+  if seconds:
+    print 'Time per map: min %.2fs, avg %.2fs, max %.2fs' % (min(seconds), sum(seconds) / len(seconds), max(seconds))
+  for r in failed:
+    print 'Failed: %s (%s) with exit code %s' % (r['job']['iso'], r['job']['lang'], r['code'])
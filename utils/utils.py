@@ -1,8 +1,14 @@
 # Climatescope utils
 
+import contextlib
+import errno
 import json
+import os
 import os.path
 import shutil
+import tempfile
+
+from profiling import traced
 
 
 def check_dir(d):
@@ -27,7 +33,12 @@ def check_create_folder(d):
     (String) the path to the folder
   """
   if not os.path.exists(d):
-    os.makedirs(d)
+    try:
+      os.makedirs(d)
+    except OSError as e:
+      # Another process may have created it in the meantime
+      if e.errno != errno.EEXIST:
+        raise
 
 
 def clean_dir(d, full = False):
@@ -54,8 +65,143 @@ def clean_dir(d, full = False):
         print e
 
 
-def write_json(f,data):
-  """Write data to a json file
+def remove_dir(d):
+  """Remove a directory and everything in it, if it exists
+  """
+  if os.path.exists(d):
+    shutil.rmtree(d, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def scratch_dir(prefix, parent=None):
+  """Create a scratch directory for a single run, for a with statement. Every
+  run gets a unique directory, so runs don't clobber each other. It is
+  removed at the end of the with statement, also when the run fails. (An
+  atexit handler would not run in the processes of multiprocessing.)
+
+  :param prefix:
+    Prefix of the name of the directory (eg. the name of the script)
+  :type prefix:
+    String
+  :param parent:
+    The directory to create it in. Defaults to the system temp directory.
+  :type parent:
+    String
+
+  :returns:
+    (String) the path to the directory
+  """
+  if parent:
+    check_create_folder(parent)
+  d = tempfile.mkdtemp(prefix=prefix, dir=parent)
+  try:
+    yield d
+  finally:
+    remove_dir(d)
+
+
+def move(src, dst):
+  """Move a file or folder with a rename, or by copying it when it's on
+  another file system
+  """
+  try:
+    os.rename(src, dst)
+  except OSError as e:
+    if e.errno != errno.EXDEV:
+      raise
+    shutil.move(src, dst)
+
+
+class Staging(object):
+  """Collects the output of a run in a staging area, and moves it into the
+  target directory only when the run is done. Every file is moved with a
+  rename, which replaces the old file atomically, so readers and runs that
+  write other files of the target directory never see half-written output.
+  When a run fails, the target directory is left as it was.
+
+  Folders that a run rebuilds from scratch can be replaced as a whole instead,
+  see replace.
+
+  :param target_dir:
+    The directory the output belongs in (eg. data/)
+  :type target_dir:
+    String
+  :param scratch_dir:
+    The scratch directory of the run. Put it on the same file system as the
+    target directory, otherwise the files are copied instead of renamed.
+  :type scratch_dir:
+    String
+  """
+
+  def __init__(self, target_dir, scratch_dir):
+    self.target_dir = target_dir
+    self.dir = os.path.join(scratch_dir, 'staging')
+    self.old_dir = os.path.join(scratch_dir, 'replaced')
+    self.replaced = []
+    check_create_folder(self.dir)
+
+  def replace(self, d):
+    """Replace a whole folder of the target directory on commit, instead of
+    only the files that were staged for it. Files of the folder that weren't
+    staged are gone afterwards, like after cleaning it before the run.
+
+    :param d:
+      Path to the folder in the target directory
+    :type d:
+      String
+    """
+    rel = os.path.normpath(os.path.relpath(d, self.target_dir))
+    if rel.startswith(os.pardir):
+      raise ValueError('%s is not in %s' % (d, self.target_dir))
+    self.replaced.append(rel)
+    check_create_folder(os.path.join(self.dir, rel))
+
+  def path(self, f):
+    """Returns the staged path of a file in the target directory, and makes
+    sure its folder exists. Files outside the target directory aren't staged.
+    """
+    rel = os.path.relpath(f, self.target_dir)
+    if rel.startswith(os.pardir):
+      staged = f
+    else:
+      staged = os.path.join(self.dir, rel)
+    if os.path.dirname(staged):
+      check_create_folder(os.path.dirname(staged))
+    return staged
+
+  def commit(self):
+    """Move all staged files into the target directory. Returns the number of
+    files that were moved.
+    """
+    count = 0
+    # Swap the replaced folders with two renames: the old folder is moved
+    # aside and removed at the end
+    for i, rel in enumerate(self.replaced):
+      src = os.path.join(self.dir, rel)
+      dst = os.path.join(self.target_dir, rel)
+      count += sum([len(files) for root, dirs, files in os.walk(src)])
+      check_create_folder(os.path.dirname(dst))
+      if os.path.exists(dst):
+        check_create_folder(self.old_dir)
+        move(dst, os.path.join(self.old_dir, str(i)))
+      move(src, dst)
+
+    for root, dirs, files in os.walk(self.dir):
+      for fn in sorted(files):
+        src = os.path.join(root, fn)
+        dst = os.path.join(self.target_dir, os.path.relpath(src, self.dir))
+        check_create_folder(os.path.dirname(dst))
+        move(src, dst)
+        count += 1
+    remove_dir(self.dir)
+    remove_dir(self.old_dir)
+    return count
+
+
+@traced
+def write_json(f,data,staging=None):
+  """Write data to a json file. The folder of the file is created when it
+  doesn't exist.
 
   :param f:
     Path to the file
@@ -63,6 +209,14 @@ def write_json(f,data):
     String
   :param data:
     Data to write to the file
+  :param staging:
+    Write the file to this staging area instead
+  :type staging:
+    Staging
   """
+  if staging is not None:
+    f = staging.path(f)
+  elif os.path.dirname(f):
+    check_create_folder(os.path.dirname(f))
   with open(f ,'w') as ofile:
     json.dump(data, ofile)